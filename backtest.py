@@ -0,0 +1,143 @@
+import os
+import glob
+import json
+import argparse
+import itertools
+import numpy as np
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from main import OptionChain, rank_main, rank_hedges, SNAP_DTYPE, SNAPSHOT_DIR, INDICES_CONFIG, HEDGE_RATIO, IST
+
+# =========================================
+# --- BACKTEST / REPLAY (recorded chain snapshots) ---
+# =========================================
+# Usage: python backtest.py --index NIFTY --from 20260901 --to 20260930 --target 80,120 --hedge RATIO:0.2,DIST:500
+# Snapshots SnapshotStore se: <SNAPSHOT_DIR>/YYYYMMDD_<INDEX>_<EXPIRY>.bin + .json (token -> symbol/strike/type)
+SL_PRESETS = [25, 50, 100, 105]
+SL_LIMIT_PAD = 10.0
+# Har process ka apna day cache (sweep mein ek din ek hi baar load)
+DAYS = {}
+
+def day_files(root, idx_name, start, end):
+    # Ek din mein kai expiries ho sakti hain: sabse zyada snapshots wali (jo users ne trade ki)
+    best = {}
+    for path in glob.glob(os.path.join(root, f"*_{idx_name}_*.bin")):
+        day = os.path.basename(path).split("_")[0]
+        if not (start <= day <= end) or not os.path.exists(path[:-4] + ".json"): continue
+        size = os.path.getsize(path)
+        if size > best.get(day, ("", -1))[1]: best[day] = (path, size)
+    return [best[d][0] for d in sorted(best)]
+
+def load_day(path):
+    if path in DAYS: return DAYS[path]
+    rec = np.fromfile(path, dtype=SNAP_DTYPE)
+    with open(path[:-4] + ".json") as f: meta = json.load(f)
+    # OptionChain order: strike wise, har strike pe CE phir PE
+    tokens = sorted(meta, key=lambda tk: (meta[tk][1], meta[tk][2]))
+    chain = OptionChain([{"TradeSymbol": meta[tk][0], "RefKey": "", "Token": tk, "Strike": meta[tk][1], "Type": meta[tk][2]} for tk in tokens])
+    times, t_i = np.unique(rec["time"], return_inverse=True)
+    order = np.argsort(chain.tokens)
+    pos = np.minimum(np.searchsorted(chain.tokens[order], rec["token"]), len(order) - 1)
+    ok = chain.tokens[order][pos] == rec["token"]
+    ltp = np.zeros((len(times), len(chain)), dtype=np.float64)
+    ltp[t_i[ok], order[pos[ok]]] = rec["ltp"][ok]
+    # Missing quote = pichla LTP (forward fill)
+    last = np.where(ltp > 0, np.arange(len(times))[:, None], 0)
+    np.maximum.accumulate(last, axis=0, out=last)
+    ltp = ltp[last, np.arange(len(chain))]
+    hm = np.array([int(datetime.fromtimestamp(t, IST).strftime("%H%M")) for t in times])
+    DAYS[path] = {"Day": os.path.basename(path).split("_")[0], "Chain": chain, "HM": hm, "LTP": ltp}
+    return DAYS[path]
+
+def simulate(day, opt_type, target, mode, value, entry, exit_at, sl_pcts):
+    # Ek din, saare SL presets ek saath: (P&L per unit, SL hit?) har preset ke liye
+    chain, hm, ltp = day["Chain"], day["HM"], day["LTP"]
+    t0, t1 = int(np.searchsorted(hm, entry)), int(np.searchsorted(hm, exit_at, side="right")) - 1
+    if t0 >= len(hm) or t1 <= t0: return None
+    chain.ltp[:] = ltp[t0]
+    mains = rank_main(chain, opt_type, target, 1)
+    if not len(mains): return None
+    m = int(mains[0])
+    hedges = rank_hedges(chain, m, mode, value, 1)
+    if not len(hedges): return None
+    h = int(hedges[0])
+    sell, buy = ltp[t0, m], ltp[t0, h]
+    # SLSET_ wala trigger; 0% = no SL
+    pcts = np.asarray(sl_pcts, dtype=np.float64)
+    trig = np.round(sell + sell * (pcts / 100), 1)
+    hit = (ltp[t0 + 1:t1 + 1, m][None, :] >= trig[:, None]) & (pcts > 0)[:, None]
+    was_hit = hit.any(axis=1)
+    at = np.where(was_hit, hit.argmax(axis=1) + t0 + 1, t1)
+    # SL-limit order: trigger se upar, limit (trigger + pad) tak fill; SL pe hedge bhi usi waqt close
+    main_exit = np.where(was_hit, np.clip(ltp[at, m], trig, trig + SL_LIMIT_PAD), ltp[t1, m])
+    return (sell - main_exit) + (ltp[at, h] - buy), was_hit
+
+def run_combo(job):
+    paths, idx_name, opt_type, target, mode, value, entry, exit_at, sl_pcts, lots = job
+    qty = lots * INDICES_CONFIG[idx_name]["LotSize"]
+    pnl, hits = [], []
+    for path in paths:
+        res = simulate(load_day(path), opt_type, target, mode, value, entry, exit_at, sl_pcts)
+        if res is None: continue
+        pnl.append(res[0] * qty); hits.append(res[1])
+    out = []
+    if not pnl: return out
+    pnl, hits = np.array(pnl), np.array(hits)
+    for j, pct in enumerate(sl_pcts):
+        p = pnl[:, j]
+        curve = np.cumsum(p)
+        out.append({"Type": opt_type, "Target": target, "Hedge": f"{mode}:{value}", "SL": pct, "Days": len(p),
+                    "Total": round(float(p.sum()), 2), "Mean": round(float(p.mean()), 2), "Median": round(float(np.median(p)), 2),
+                    "P5": round(float(np.percentile(p, 5)), 2), "P95": round(float(np.percentile(p, 95)), 2),
+                    "Win%": round(float((p > 0).mean() * 100), 1), "SLHit%": round(float(hits[:, j].mean() * 100), 1),
+                    "MaxDD": round(float((np.maximum.accumulate(np.maximum(curve, 0)) - curve).max()), 2)})
+    return out
+
+def parse_hedges(text):
+    hedges = []
+    for part in text.split(","):
+        mode, _, value = part.partition(":")
+        hedges.append((mode.upper(), float(value) if value else HEDGE_RATIO))
+    return hedges
+
+def main():
+    ap = argparse.ArgumentParser(description="Replay sell + hedge strategy over recorded chain snapshots")
+    ap.add_argument("--index", default="NIFTY", choices=list(INDICES_CONFIG.keys()))
+    ap.add_argument("--dir", default=SNAPSHOT_DIR)
+    ap.add_argument("--from", dest="start", default="00000000")
+    ap.add_argument("--to", dest="end", default="99999999")
+    ap.add_argument("--type", default="CE,PE")
+    ap.add_argument("--target", default="100", help="Main leg premium targets (comma separated)")
+    ap.add_argument("--hedge", default=f"RATIO:{HEDGE_RATIO}", help="MODE:value list, MODE = RATIO / DIST / DELTA")
+    ap.add_argument("--sl", default=",".join(str(p) for p in SL_PRESETS), help="SL % presets, 0 = no SL")
+    ap.add_argument("--entry", default="0920", help="HHMM")
+    ap.add_argument("--exit", default="1515", help="HHMM")
+    ap.add_argument("--lots", type=int, default=1)
+    ap.add_argument("--workers", type=int, default=os.cpu_count())
+    ap.add_argument("--csv", help="Results CSV path")
+    args = ap.parse_args()
+
+    paths = day_files(args.dir, args.index, args.start, args.end)
+    if not paths: return print(f"❌ No snapshots for {args.index} in {args.dir}")
+    sl_pcts = [float(p) for p in args.sl.split(",")]
+    jobs = [(paths, args.index, t, float(tg), mode, value, int(args.entry), int(args.exit), sl_pcts, args.lots)
+            for t, tg, (mode, value) in itertools.product(args.type.upper().split(","), args.target.split(","), parse_hedges(args.hedge))]
+
+    # Param sweep processes mein; ek combo hai to seedha
+    if len(jobs) > 1 and args.workers > 1:
+        with ProcessPoolExecutor(max_workers=min(args.workers, len(jobs))) as pool: results = list(pool.map(run_combo, jobs))
+    else: results = [run_combo(job) for job in jobs]
+    rows = sorted((r for res in results for r in res), key=lambda r: -r["Total"])
+    if not rows: return print("❌ No trades (entry/exit window ya target check karein)")
+
+    cols = list(rows[0].keys())
+    print(f"📊 {args.index} | {len(paths)} days ({os.path.basename(paths[0])[:8]} - {os.path.basename(paths[-1])[:8]}) | Lots: {args.lots}")
+    print(" ".join(f"{c:>10}" for c in cols))
+    for r in rows: print(" ".join(f"{str(r[c]):>10}" for c in cols))
+    if args.csv:
+        with open(args.csv, "w") as f:
+            f.write(",".join(cols) + "\n")
+            for r in rows: f.write(",".join(str(r[c]) for c in cols) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,426 @@
+import os
+import sys
+import json
+import time
+import types as pytypes
+import random
+import argparse
+import threading
+import itertools
+import numpy as np
+import pymongo
+from bson import ObjectId
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+# =========================================
+# --- BENCHMARK: fake broker + in-process MongoDB, N chats, p50/p99 per flow ---
+# =========================================
+# Usage: python bench.py --chats 50 --rounds 3 --latency 40 --rate 10 --mongo-latency 5
+# main.py import se pehle NeoAPI aur MongoClient yahan ke stand-ins se replace hote hain.
+SPOT = {"NIFTY": 24000.0, "SENSEX": 80000.0}
+GAPS = {"NIFTY": 50, "SENSEX": 100}
+EXPIRY_DAY = {"NIFTY": 1, "SENSEX": 3}
+CALLS = Counter()
+CALLS_LOCK = threading.Lock()
+# Handlers error pakad ke "❌" reply karte hain: wahi yahan error count
+REPLY_ERRORS = Counter()
+ERROR_CHATS = Counter()
+CONF = {"Latency": 0.04, "Jitter": 0.02, "Rate": 10, "FillRate": 0.98, "SLHitRate": 0.05, "MongoLatency": 0.005}
+
+def count(name):
+    with CALLS_LOCK: CALLS[name] += 1
+
+def pause(base):
+    if base > 0: time.sleep(base + random.random() * CONF["Jitter"])
+
+# --- In-process MongoDB stand-in (sirf wahi jo main.py use karta hai) ---
+def match(doc, flt):
+    for k, v in (flt or {}).items():
+        have = doc.get(k)
+        if isinstance(v, dict) and any(op.startswith("$") for op in v):
+            for op, arg in v.items():
+                if op == "$gt" and not (have is not None and have > arg): return False
+                if op == "$gte" and not (have is not None and have >= arg): return False
+                if op == "$lt" and not (have is not None and have < arg): return False
+                if op == "$in" and have not in arg: return False
+                if op == "$nin" and have in arg: return False
+                if op == "$ne" and have == arg: return False
+                if op == "$exists" and (k in doc) != bool(arg): return False
+        elif have != v: return False
+    return True
+
+def project(doc, fields):
+    if not fields: return dict(doc)
+    keep = {k for k, v in fields.items() if v}
+    if not keep: return {k: v for k, v in doc.items() if k not in fields}
+    out = {k: doc[k] for k in keep if k in doc}
+    if fields.get("_id", 1) and "_id" in doc: out["_id"] = doc["_id"]
+    return out
+
+class FakeCollection:
+    def __init__(self, name):
+        self.name, self.docs, self.ids, self.lock = name, [], set(), threading.RLock()
+
+    def _op(self, name):
+        count(f"mongo.{self.name}.{name}")
+        pause(CONF["MongoLatency"])
+
+    def find(self, flt=None, fields=None):
+        self._op("find")
+        with self.lock: return iter([project(d, fields) for d in self.docs if match(d, flt)])
+
+    def find_one(self, flt=None, fields=None):
+        self._op("find_one")
+        with self.lock: return next((project(d, fields) for d in self.docs if match(d, flt)), None)
+
+    def count_documents(self, flt=None):
+        self._op("count")
+        with self.lock: return sum(1 for d in self.docs if match(d, flt))
+
+    def _insert(self, doc):
+        doc = dict(doc)
+        doc.setdefault("_id", ObjectId())
+        if doc["_id"] in self.ids:
+            raise pymongo.errors.DuplicateKeyError("E11000 duplicate key", 11000)
+        self.ids.add(doc["_id"])
+        self.docs.append(doc)
+
+    def _update(self, flt, update, upsert=False, many=False):
+        hit = 0
+        for d in self.docs:
+            if not match(d, flt): continue
+            d.update(update.get("$set", {}))
+            for k in update.get("$unset", {}): d.pop(k, None)
+            hit += 1
+            if not many: break
+        if not hit and upsert:
+            doc = {k: v for k, v in flt.items() if not isinstance(v, dict)}
+            doc.update(update.get("$setOnInsert", {})); doc.update(update.get("$set", {}))
+            self._insert(doc)
+        return hit
+
+    def insert_one(self, doc):
+        self._op("insert_one")
+        with self.lock: self._insert(doc)
+
+    def update_one(self, flt, update, upsert=False):
+        self._op("update_one")
+        with self.lock: return pytypes.SimpleNamespace(matched_count=self._update(flt, update, upsert))
+
+    def update_many(self, flt, update, upsert=False):
+        self._op("update_many")
+        with self.lock: return pytypes.SimpleNamespace(matched_count=self._update(flt, update, upsert, many=True))
+
+    def delete_one(self, flt):
+        self._op("delete_one")
+        with self.lock:
+            for i, d in enumerate(self.docs):
+                if match(d, flt):
+                    self.ids.discard(self.docs.pop(i)["_id"])
+                    return pytypes.SimpleNamespace(deleted_count=1)
+        return pytypes.SimpleNamespace(deleted_count=0)
+
+    def delete_many(self, flt):
+        self._op("delete_many")
+        with self.lock:
+            keep = [d for d in self.docs if not match(d, flt)]
+            n, self.docs[:] = len(self.docs) - len(keep), keep
+            self.ids = {d["_id"] for d in keep}
+        return pytypes.SimpleNamespace(deleted_count=n)
+
+    def bulk_write(self, ops, ordered=True):
+        self._op("bulk_write")
+        with self.lock:
+            for i, op in enumerate(ops):
+                try:
+                    if isinstance(op, pymongo.InsertOne): self._insert(op._doc)
+                    elif isinstance(op, pymongo.UpdateMany): self._update(op._filter, op._doc, op._upsert, many=True)
+                    elif isinstance(op, pymongo.UpdateOne): self._update(op._filter, op._doc, op._upsert)
+                    elif isinstance(op, pymongo.DeleteOne): self.delete_one(op._filter)
+                    elif isinstance(op, pymongo.DeleteMany): self.delete_many(op._filter)
+                except pymongo.errors.DuplicateKeyError as e:
+                    raise pymongo.errors.BulkWriteError({"writeErrors": [{"index": i, "code": 11000, "errmsg": str(e)}]})
+        return pytypes.SimpleNamespace(acknowledged=True)
+
+    def create_index(self, keys, **kw):
+        self._op("create_index")
+        return kw.get("name", "idx")
+
+class FakeDatabase(dict):
+    def __missing__(self, name):
+        self[name] = FakeCollection(name)
+        return self[name]
+
+class FakeMongoClient:
+    # Saare clients ek hi in-process data dekhte hain
+    DBS = {}
+
+    def __init__(self, *a, **kw): pass
+
+    def __getitem__(self, name):
+        return self.DBS.setdefault(name, FakeDatabase())
+
+# --- fo_master seed: NIFTY/SENSEX weekly options + monthly futures ---
+def seed_master(col, path=None, weeks=6, width=100):
+    if path:
+        with open(path) as f:
+            for line in f:
+                if line.strip(): col._insert(json.loads(line))
+        return len(col.docs)
+    token, today = itertools.count(40000), datetime.now().date()
+    for idx, spot in SPOT.items():
+        gap = GAPS[idx]
+        atm = round(spot / gap) * gap
+        for m in range(2):
+            month = (today.replace(day=1) + timedelta(days=32 * m)).strftime("%y%b").upper()
+            col._insert({"0": str(next(token)), "5": f"{idx}{month}FUT", "7": f"{idx}{month}FUT", "IndexName": idx})
+        first = today + timedelta(days=(EXPIRY_DAY[idx] - today.weekday()) % 7)
+        for w in range(weeks):
+            exp = (first + timedelta(weeks=w)).strftime("%d%b%y").upper()
+            for k in range(-width, width + 1):
+                stk = atm + k * gap
+                for t in ("CE", "PE"):
+                    col._insert({"0": str(next(token)), "5": f"{idx}{exp}{stk}{t}", "7": f"{idx}{exp}{stk}{t}", "IndexName": idx})
+    return len(col.docs)
+
+# --- Fake Kotak NeoAPI: latency, per-session rate limit, fills ---
+class FakeMarket:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens = {}
+
+    def load(self, col):
+        for d in col.docs:
+            m = REF_RE.match(d["7"])
+            self.tokens[str(d["0"])] = (d["IndexName"], float(m.group(3)), m.group(4)) if m else (d["IndexName"], None, "FUT")
+
+    def ltp(self, token):
+        idx, stk, t = self.tokens.get(str(token), ("NIFTY", None, "FUT"))
+        spot = SPOT[idx]
+        if stk is None: return round(spot, 2)
+        intr = max(spot - stk, 0) if t == "CE" else max(stk - spot, 0)
+        return round(intr + 2 + spot * 0.006 * np.exp(-abs(spot - stk) / (spot * 0.012)), 2)
+
+    def tick(self):
+        with self.lock:
+            for idx in SPOT: SPOT[idx] *= 1 + random.gauss(0, 0.0004)
+
+MARKET = FakeMarket()
+REF_RE = __import__("re").compile(r"^([A-Z]+)(\d{2}[A-Z]{3}\d{2})(\d+(?:\.\d+)?)(CE|PE)$")
+
+class FakeNeoAPI:
+    def __init__(self, consumer_key=None, environment="prod", **kw):
+        self.consumer_key, self.orders, self.calls = consumer_key, {}, []
+        self.lock = threading.Lock()
+        self.configuration = pytypes.SimpleNamespace(edit_token="t", edit_sid="s", serverId="1", edit_rid="r", bearer_token="b")
+        self.on_message = self.on_open = self.on_close = self.on_error = None
+
+    def _call(self, name):
+        count(f"broker.{name}")
+        now = time.time()
+        with self.lock:
+            self.calls = [t for t in self.calls if now - t < 1] + [now]
+            limited = CONF["Rate"] and len(self.calls) > CONF["Rate"]
+        pause(CONF["Latency"])
+        if limited:
+            count("broker.rate_limited")
+            raise Exception("429 Too Many Requests")
+
+    def totp_login(self, **kw): self._call("totp_login")
+    def totp_validate(self, **kw): self._call("totp_validate")
+
+    def quotes(self, instrument_tokens=(), quote_type="all", **kw):
+        self._call("quotes")
+        MARKET.tick()
+        return [{"exchange_token": d["instrument_token"], "ltp": MARKET.ltp(d["instrument_token"]), "open_int": random.randint(1000, 500000)} for d in instrument_tokens]
+
+    def place_order(self, trading_symbol=None, transaction_type=None, order_type="MKT", quantity="0", trigger_price=None, **kw):
+        self._call("place_order")
+        oid = str(next(ORDER_IDS))
+        token = SYMBOL_TOKENS.get(trading_symbol)
+        if order_type == "SL":
+            status = "COMPLETE" if random.random() < CONF["SLHitRate"] else "TRIGGER PENDING"
+            price = float(trigger_price or 0)
+        else:
+            status = "COMPLETE" if random.random() < CONF["FillRate"] else "REJECTED"
+            price = MARKET.ltp(token) if token else 0.0
+        with self.lock: self.orders[oid] = {"nOrdNo": oid, "ordSt": status, "avgPrc": price if status == "COMPLETE" else 0, "fldQty": int(quantity) if status == "COMPLETE" else 0}
+        return {"nOrdNo": oid, "stat": "Ok"}
+
+    def cancel_order(self, order_id=None, **kw):
+        self._call("cancel_order")
+        with self.lock:
+            o = self.orders.get(str(order_id))
+            if o and o["ordSt"] != "COMPLETE": o["ordSt"] = "CANCELLED"
+        return {"stat": "Ok"}
+
+    def order_report(self):
+        self._call("order_report")
+        with self.lock: return {"data": [dict(o) for o in self.orders.values()]}
+
+    def trade_report(self):
+        self._call("trade_report")
+        with self.lock: return {"data": [dict(o) for o in self.orders.values() if o["ordSt"] == "COMPLETE"]}
+
+    def subscribe(self, **kw): self._call("subscribe")
+    def un_subscribe(self, **kw): self._call("un_subscribe")
+    def subscribe_to_orderfeed(self): self._call("subscribe_to_orderfeed")
+
+ORDER_IDS = itertools.count(260000000001)
+SYMBOL_TOKENS = {}
+
+def install_fakes():
+    pymongo.MongoClient = FakeMongoClient
+    sys.modules["neo_api_client"] = pytypes.SimpleNamespace(NeoAPI=FakeNeoAPI)
+    os.environ.setdefault("BOT_TOKEN", "0:bench")
+    os.environ.setdefault("STREAMING", "0")
+    os.environ.setdefault("SNAPSHOT_DIR", os.path.join("/tmp", "bench_snapshots"))
+
+class FakeBot:
+    # Telegram calls: network nahi, sirf count
+    def __init__(self, real):
+        self.real = real
+
+    def __getattr__(self, name):
+        if name in ("send_message", "edit_message_text", "answer_callback_query", "delete_message", "pin_chat_message", "edit_message_reply_markup"):
+            def sent(*a, **kw):
+                count(f"telegram.{name}")
+                text = kw.get("text", a[1] if name == "send_message" and len(a) > 1 else a[0] if name == "edit_message_text" and a else "")
+                if isinstance(text, str) and "❌" in text:
+                    count("telegram.error_reply")
+                    chat = kw.get("chat_id", a[0] if name == "send_message" and a else a[1] if len(a) > 1 else 0)
+                    with CALLS_LOCK:
+                        REPLY_ERRORS[next(l for l in text.splitlines() if "❌" in l).strip()[:60]] += 1
+                        ERROR_CHATS[chat] += 1
+                return pytypes.SimpleNamespace(message_id=1, chat=pytypes.SimpleNamespace(id=a[0] if a else 0))
+            return sent
+        return getattr(self.real, name)
+
+# --- Flows ---
+def fake_call(cid, data):
+    msg = pytypes.SimpleNamespace(chat=pytypes.SimpleNamespace(id=cid), message_id=1)
+    return pytypes.SimpleNamespace(id="1", data=data, message=msg, from_user=pytypes.SimpleNamespace(id=cid))
+
+# Har flow apna expected result check kare (handler ka silent fail bhi error gina jaye)
+def flow_chain(main, cid):
+    main.ACTIVE_TOKENS.pop(cid, None)
+    ok, msg = main.auto_generate_chain(cid)
+    if not ok: raise Exception(msg)
+    if not main.ACTIVE_TOKENS.get(cid): raise Exception("chain: empty")
+
+def flow_fetch(main, cid):
+    ok, msg = main.fetch_data_for_user(cid, max_age=0)
+    if not ok: raise Exception(msg)
+    if not (main.ACTIVE_TOKENS[cid].ltp > 0).any(): raise Exception("fetch: no LTP")
+
+def flow_trade(main, cid):
+    main.PENDING_TRADE[cid] = {"Type": random.choice(["CE", "PE"]), "Target": 60.0, "Qty": main.INDICES_CONFIG[main.USER_SETTINGS[cid]["Index"]]["LotSize"]}
+    msg, mk = main.trade_confirm(cid)
+    if not mk: raise Exception(msg)
+    before = len(main.open_rows(cid))
+    main.on_callback(fake_call(cid, "EXECUTE_TRADE"))
+    if len(main.open_rows(cid)) - before != 2: raise Exception("trade: main + hedge not opened")
+
+def flow_sl(main, cid):
+    for row in main.find_open_trades(cid, "SELL"):
+        if row.get("SLOrderID") in main.NO_SL: main.on_callback(fake_call(cid, f"SLSET_{row['OrderID']}_50"))
+    if any(r.get("SLOrderID") in main.NO_SL for r in main.find_open_trades(cid, "SELL")): raise Exception("sl: SL not set")
+
+def flow_exit(main, cid):
+    main.on_callback(fake_call(cid, "EXIT_ALL_CONFIRM"))
+    if main.open_rows(cid): raise Exception("exit: positions still open")
+
+def run_flow(main, name, fn, cids, rounds):
+    lat, errors = [], Counter()
+    before, replies = Counter(CALLS), Counter(REPLY_ERRORS)
+    def one(cid):
+        t, replied = time.perf_counter(), ERROR_CHATS[cid]
+        try: fn(main, cid)
+        except Exception as e:
+            # Handler ne ❌ reply kar diya to wahi gina jayega, dobara nahi
+            if ERROR_CHATS[cid] == replied: errors[str(e)[:60]] += 1
+        return (time.perf_counter() - t) * 1000
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(cids)) as pool:
+        for _ in range(rounds): lat.extend(pool.map(one, cids))
+    wall = time.perf_counter() - start
+    errors.update(REPLY_ERRORS - replies)
+    return report(name, lat, before, wall, errors)
+
+def run_monitor(main, steps):
+    # SL monitor ek hi thread hai: har step = saare sessions ka reconcile poll
+    lat, before, replies = [], Counter(CALLS), Counter(REPLY_ERRORS)
+    start = time.perf_counter()
+    for _ in range(steps):
+        main.SL_STATE["LastPoll"] = 0
+        t = time.perf_counter()
+        main.sl_monitor_step()
+        lat.append((time.perf_counter() - t) * 1000)
+    return report("sl_monitor_step", lat, before, time.perf_counter() - start, REPLY_ERRORS - replies)
+
+def report(name, lat, before, wall, errors):
+    lat = np.array(lat) if lat else np.zeros(1)
+    calls = {k: v - before.get(k, 0) for k, v in CALLS.items() if v - before.get(k, 0)}
+    # Broker 429 = flow limit se tez, error hi hai (retry se bacha ho tab bhi)
+    if calls.get("broker.rate_limited"): errors = errors + Counter({"broker 429 Too Many Requests": calls["broker.rate_limited"]})
+    row = {"Flow": name, "N": len(lat), "p50": round(float(np.percentile(lat, 50)), 1), "p99": round(float(np.percentile(lat, 99)), 1),
+           "Max": round(float(lat.max()), 1), "Wall": round(wall, 2), "Errors": sum(errors.values()),
+           "Broker": sum(v for k, v in calls.items() if k.startswith("broker.") and k != "broker.rate_limited"), "Mongo": sum(v for k, v in calls.items() if k.startswith("mongo.")),
+           "Calls": calls, "ErrorTypes": dict(errors)}
+    print(f"{name:>16} | n={row['N']:<5} p50={row['p50']:>8}ms p99={row['p99']:>8}ms max={row['Max']:>8}ms | broker={row['Broker']:<6} mongo={row['Mongo']:<6} errors={row['Errors']}")
+    for k in sorted(calls): print(f"{'':>16}   {k}: {calls[k]}")
+    for k, v in errors.items(): print(f"{'':>16}   ❌ {k}: {v}")
+    return row
+
+def main():
+    ap = argparse.ArgumentParser(description="Load test main.py hot paths against a fake broker and MongoDB")
+    ap.add_argument("--chats", type=int, default=20)
+    ap.add_argument("--rounds", type=int, default=3)
+    ap.add_argument("--latency", type=float, default=40, help="Broker latency ms")
+    ap.add_argument("--jitter", type=float, default=20, help="Broker/Mongo jitter ms")
+    ap.add_argument("--rate", type=int, default=10, help="Broker calls/sec per session (0 = unlimited)")
+    ap.add_argument("--fill-rate", type=float, default=0.98)
+    ap.add_argument("--sl-hit-rate", type=float, default=0.05)
+    ap.add_argument("--mongo-latency", type=float, default=5, help="Mongo latency ms")
+    ap.add_argument("--master", help="fo_master JSON lines dump (default: synthetic)")
+    ap.add_argument("--flows", default="chain,fetch,trade,sl,monitor,exit")
+    ap.add_argument("--json", help="Results JSON path")
+    ap.add_argument("--metrics", action="store_true", help="Print the bot's /metrics output at the end")
+    ap.add_argument("--seed", type=int, default=7)
+    args = ap.parse_args()
+    random.seed(args.seed)
+    CONF.update({"Latency": args.latency / 1000, "Jitter": args.jitter / 1000, "Rate": args.rate,
+                 "FillRate": args.fill_rate, "SLHitRate": args.sl_hit_rate, "MongoLatency": args.mongo_latency / 1000})
+
+    install_fakes()
+    master = FakeMongoClient()["tradingbot"]["fo_master"]
+    rows = seed_master(master, args.master)
+    MARKET.load(master)
+    SYMBOL_TOKENS.update({d["5"]: str(d["0"]) for d in master.docs})
+    import main as bot_main
+    bot_main.bot = FakeBot(bot_main.bot)
+    bot_main.load_state()
+    threading.Thread(target=bot_main.trade_writer, daemon=True).start()
+
+    cids = list(range(1000, 1000 + args.chats))
+    for i, cid in enumerate(cids):
+        bot_main.USER_SESSIONS[cid] = bot_main.instrument_client(FakeNeoAPI(consumer_key=f"bench{cid}"))
+        bot_main.USER_SETTINGS[cid] = {"Index": "NIFTY" if i % 2 == 0 else "SENSEX", "ATM": None}
+        bot_main.USER_DETAILS[cid] = {"Name": f"bench{cid}"}
+    print(f"🧪 {args.chats} chats x {args.rounds} rounds | fo_master rows: {rows} | broker {args.latency}ms, {args.rate}/s | mongo {args.mongo_latency}ms")
+
+    flows = {"chain": flow_chain, "fetch": flow_fetch, "trade": flow_trade, "sl": flow_sl, "exit": flow_exit}
+    results = []
+    for name in args.flows.split(","):
+        # Pichle flow ki 1s rate window khatam hone do (flows ek dusre ka limit na khayein)
+        if results: time.sleep(1.1)
+        if name == "monitor": results.append(run_monitor(bot_main, args.rounds))
+        elif name in flows: results.append(run_flow(bot_main, name, flows[name], cids, 1 if name in ("sl", "exit") else args.rounds))
+    if args.json:
+        with open(args.json, "w") as f: json.dump(results, f, indent=1)
+    if args.metrics: print(bot_main.health_response("/metrics")[2].decode())
+
+if __name__ == "__main__":
+    main()
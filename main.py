@@ -1,14 +1,25 @@
 import telebot
 from telebot import types
-import pandas as pd
+import numpy as np
 import time
 import os
 import threading
 import requests
 import io
+import re
+import json
+import csv
+import asyncio
+import queue
+import bisect
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from neo_api_client import NeoAPI
-from datetime import datetime, timedelta
-from pymongo import MongoClient
+from datetime import datetime, timedelta, timezone
+from pymongo import MongoClient, UpdateOne, InsertOne, monitoring
+from pymongo.errors import BulkWriteError
+from bson import ObjectId
 
 # =========================================
 # --- CONFIGURATION & MONGODB ---
@@ -17,14 +28,82 @@ from pymongo import MongoClient
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 MONGO_URI = os.getenv("MONGO_URI")
 
+# --- Metrics: counters + latency histograms, /metrics pe Prometheus format ---
+METRICS = {}
+METRICS_LOCK = threading.Lock()
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BROKER_CALLS = ("quotes", "place_order", "cancel_order", "order_report", "trade_report", "subscribe", "un_subscribe", "subscribe_to_orderfeed", "scrip_master")
+
+def metric_inc(name, n=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with METRICS_LOCK: METRICS[key] = METRICS.get(key, 0) + n
+
+def metric_observe(name, seconds, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with METRICS_LOCK:
+        h = METRICS.get(key)
+        if h is None: h = METRICS[key] = {"Buckets": [0] * (len(METRIC_BUCKETS) + 1), "Sum": 0.0, "Count": 0}
+        h["Buckets"][bisect.bisect_left(METRIC_BUCKETS, seconds)] += 1
+        h["Sum"] += seconds
+        h["Count"] += 1
+
+class timed:
+    # with timed("name", label=..): ya @timed("name") decorator
+    def __init__(self, name, **labels):
+        self.name, self.labels = name, labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        metric_observe(self.name + "_seconds", time.perf_counter() - self.start, **self.labels)
+        if exc_type: metric_inc(self.name + "_errors_total", **self.labels)
+        return False
+
+    def __call__(self, fn):
+        def wrapper(*args, **kwargs):
+            with timed(self.name, **self.labels): return fn(*args, **kwargs)
+        wrapper.__name__ = fn.__name__
+        return wrapper
+
+class MongoMetrics(monitoring.CommandListener):
+    # Har Mongo command ka time, collection ke saath
+    def __init__(self):
+        self.pending = {}
+
+    def started(self, event):
+        coll = event.command.get("collection" if event.command_name == "getMore" else event.command_name)
+        self.pending[(event.connection_id, event.request_id)] = coll if isinstance(coll, str) else ""
+
+    def succeeded(self, event):
+        coll = self.pending.pop((event.connection_id, event.request_id), "")
+        metric_observe("opbot_mongo_seconds", event.duration_micros / 1e6, command=event.command_name, collection=coll)
+
+    def failed(self, event):
+        coll = self.pending.pop((event.connection_id, event.request_id), "")
+        metric_observe("opbot_mongo_seconds", event.duration_micros / 1e6, command=event.command_name, collection=coll)
+        metric_inc("opbot_mongo_errors_total", command=event.command_name, collection=coll)
+
+def instrument_client(client):
+    # Broker SDK ke har call pe timer (instance level, SDK untouched)
+    for call in BROKER_CALLS:
+        fn = getattr(client, call, None)
+        if fn is None or getattr(fn, "timed", False): continue
+        wrapper = timed("opbot_broker", call=call)(fn)
+        wrapper.timed = True
+        setattr(client, call, wrapper)
+    return client
+
 # MongoDB Setup
-mongo_client = MongoClient(MONGO_URI)
+mongo_client = MongoClient(MONGO_URI, event_listeners=[MongoMetrics()])
 db = mongo_client["tradingbot"]
 
 # Collections
 users_col = db["users"]
 trades_col = db["trades"]
 fo_master_col = db["fo_master"]
+sessions_col = db["sessions"]
 
 # Url hata diya gaya hai kyunki ab data direct MongoDB se aayega
 INDICES_CONFIG = {
@@ -40,12 +119,163 @@ USER_STATE = {}
 PENDING_TRADE = {}
 ACTIVE_TOKENS = {} 
 
+# F&O master cache (ek baar load, din mein ek baar refresh)
+MASTER_CACHE = {}
+MASTER_LOCK = threading.Lock()
+# Shared quote snapshot: (index, expiry) -> {"Tokens", "Polled", "Quotes", "Time"}
+MARKET_DATA = {}
+MARKET_LOCKS = {}
+QUOTE_TTL = 30
+
+# Quote batches parallel mein, har session pe rate limit
+QUOTE_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="quotes")
+QUOTE_BATCH = 50
+QUOTE_RATE = 5
+QUOTE_RETRIES = 3
+RATE_LIMITERS = weakref.WeakKeyDictionary()
+RATE_LOCK = threading.Lock()
+
+# Live feed (websocket): ek session ka feed, ticks (exchange, token) se
+STREAMING = os.getenv("STREAMING", "1") == "1"
+LIVE_TICKS = {}
+FEED = {"Client": None, "Open": False, "Subscribed": set(), "LastTick": 0}
+FEED_STALE = 120
+FEED_LOCK = threading.Lock()
+
+# Order feed events -> SL monitor (fallback: har session ka ek order book call)
+SL_EVENTS = queue.Queue()
+SL_POLL_INTERVAL = 15
+ORDER_FEEDS = {}
+# Exit/SL orders jinka actual fill price abhi record nahi hua: cid -> {order_id: {"Row", "Date", "Time"}}
+PENDING_EXITS = {}
+# Book mein nahi / price kabhi nahi aaya: itne second baad chhod do (LTP/SLPrice wala exit price rahega)
+PENDING_EXIT_TTL = 300
+
+# Order execution: ek phase ke saare orders parallel
+ORDER_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="orders")
+FILL_TIMEOUT = 5
+FINAL_STATUSES = ['COMPLETE', 'FILLED', 'REJECTED', 'CANCELLED']
+# Order feed ke final statuses: order_id -> {Status, Price}; waiters hedge confirm ke liye
+ORDER_UPDATES = {}
+ORDER_WAITERS = {}
+ORDER_LOCK = threading.Lock()
+ORDER_UPDATES_MAX = 1000
+HEDGE_WAIT = 2
+
+# Din ka pehla OI (OI change since open ke liye)
+OPEN_OI = {"Date": None, "OI": {}}
+OI_RANGES = [1, 2, 3, 5, 10]
+
+# Intraday snapshots: memory mein last SNAPSHOT_WINDOW, poora din disk pe (memmap)
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshots")
+SNAPSHOT_WINDOW = 240
+SNAPSHOT_GAP = 60
+SNAP_DTYPE = np.dtype([("time", "f8"), ("token", "i8"), ("ltp", "f4"), ("oi", "i8")])
+
+# Live P&L: ek pinned message, ticks pe incremental recompute, edits throttled
+LIVE_PNL = {}
+PNL_WATCH = {}
+PNL_LOCK = threading.Lock()
+PNL_EDIT_INTERVAL = 3
+PNL_LIVE_TTL = 1800
+
+# Strike selection: hedge default main premium ka 20%
+HEDGE_RATIO = 0.20
+HEDGE_MODES = {"RATIO": "Premium", "DIST": "Strike Dist", "DELTA": "Delta"}
+
+# Handler dispatch: har chat ki apni ordered queue, workers shared
+CHAT_WORKERS = int(os.getenv("CHAT_WORKERS", 16))
+# "threaded" (TeleBot + threads) ya "async" (AsyncTeleBot + ek event loop)
+BOT_MODE = os.getenv("BOT_MODE", "threaded")
+
+# Adaptive refresh: har (index, expiry) key ki cadence need se, sirf market hours mein, global broker budget
+IST = timezone(timedelta(hours=5, minutes=30))
+MARKET_HOURS = ((9, 15), (15, 30))
+MARKET_HOLIDAYS = {d.strip() for d in os.getenv("MARKET_HOLIDAYS", "").split(",") if d.strip()}
+REFRESH_FAST = 15
+REFRESH_ACTIVE = 60
+REFRESH_IDLE = 300
+ACTIVE_WINDOW = 900
+REFRESH_BUDGET = int(os.getenv("REFRESH_BUDGET", "120"))
+LAST_ACTIVE = {}
+REFRESH_DUE = {}
+
+# Broker sessions: encrypted MongoDB mein, restart ke baad lazy restore
+SESSION_KEY = os.getenv("SESSION_KEY")
+SESSION_FIELDS = ["bearer_token", "view_token", "edit_token", "edit_sid", "edit_rid", "sid", "serverId", "userId", "base_url", "login_params"]
+SESSION_EXPIRY_HOUR = 23
+SESSION_WARN = 1800
+SESSION_CHECK_INTERVAL = 600
+SAVED_SESSIONS = {}
+SESSION_LOCK = threading.Lock()
+
+# F&O master ingest: broker ka daily scrip master CSV (stream) -> fo_master, sirf changed contracts
+SCRIP_MASTER_URLS = [u.strip() for u in os.getenv("SCRIP_MASTER_URLS", "").split(",") if u.strip()]
+# /ingest_master sirf in chats se (comma separated chat ids; khali = command band, daily auto ingest chalta rahega)
+ADMIN_CHAT_IDS = {int(c) for c in os.getenv("ADMIN_CHAT_IDS", "").split(",") if c.strip()}
+SCRIP_COLS = {"0": "pSymbol", "2": "pExchSeg", "3": "pInstType", "4": "pSymbolName", "5": "pTrdSymbol", "7": "pScripRefKey", "Lot": "lLotSize"}
+MASTER_FIELDS = ("5", "7", "IndexName", "Exchange", "InstType", "Type", "Strike", "Expiry", "LotSize")
+INGEST_CHUNK = 5000
+INGEST_HOUR = 8
+INGEST_STATE = {"Date": None}
+
+# RefKey format: NIFTY27MAR2522000.00CE -> (index, expiry, strike, CE/PE)
+REF_KEY_RE = re.compile(r"^([A-Z]+)(\d{2}[A-Z]{3}\d{2})(\d+(?:\.\d+)?)(CE|PE)$")
+
 # =========================================
 # --- 1. SETUP & MONGODB MANAGEMENT ---
 # =========================================
 print("🚀 Starting Advanced Algo Bot with Auto-SL Monitoring (MongoDB Edition)...")
 USER_SESSIONS.clear()
-bot = telebot.TeleBot(BOT_TOKEN)
+
+class ChatDispatcher:
+    def __init__(self, workers):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chat")
+        self.queues = {}
+        self.lock = threading.Lock()
+
+    def submit(self, key, task, *args, **kwargs):
+        with self.lock:
+            q = self.queues.get(key)
+            if q is not None:
+                q.append((task, args, kwargs, time.perf_counter()))
+                return
+            self.queues[key] = deque([(task, args, kwargs, time.perf_counter())])
+        self.pool.submit(self._drain, key)
+
+    def _drain(self, key):
+        # Ek chat ka ek hi drainer: message order same rahega
+        while True:
+            with self.lock:
+                q = self.queues[key]
+                if not q:
+                    del self.queues[key]
+                    return
+                task, args, kwargs, queued = q.popleft()
+            metric_observe("opbot_dispatch_wait_seconds", time.perf_counter() - queued)
+            try: run_handler(task, *args, **kwargs)
+            except Exception as e:
+                metric_inc("opbot_errors_total", where="handler")
+                print(f"Handler Error ({key}): {e}")
+
+    def depth(self):
+        with self.lock: return sum(len(q) for q in self.queues.values())
+
+def run_handler(task, *args, **kwargs):
+    with timed("opbot_handler", update=kwargs.get("update_type", getattr(task, "__name__", "task"))):
+        return task(*args, **kwargs)
+
+class ChatTeleBot(telebot.TeleBot):
+    def _exec_task(self, task, *args, **kwargs):
+        update = args[0] if args else None
+        chat = getattr(update, 'chat', None) or getattr(getattr(update, 'message', None), 'chat', None)
+        if chat is not None: LAST_ACTIVE[chat.id] = time.time()
+        # Async mode mein ordering event loop karta hai, yahan inline chalao
+        if chat is None or BOT_MODE == "async": return super()._exec_task(run_handler, task, *args, **kwargs)
+        DISPATCHER.submit(chat.id, task, *args, **kwargs)
+
+DISPATCHER = ChatDispatcher(CHAT_WORKERS)
+bot = ChatTeleBot(BOT_TOKEN, threaded=(BOT_MODE != "async"))
 
 def load_users():
     try:
@@ -66,7 +296,6 @@ def load_users():
                 USER_SETTINGS[cid] = {"Index": "NIFTY", "ATM": None}
     except Exception as e: 
         print(f"Load Error: {e}")
-load_users()
 
 def save_new_user(cid, data):
     new_row = {
@@ -86,18 +315,262 @@ def save_new_user(cid, data):
         print(f"MongoDB Insert Error: {e}")
         return False
 
+def session_cipher():
+    # cryptography optional hai: na ho ya key na ho to persistence off
+    if not SESSION_KEY: return None
+    try:
+        from cryptography.fernet import Fernet
+        return Fernet(SESSION_KEY.encode())
+    except Exception as e:
+        print(f"Session Cipher Error: {e}")
+        return None
+
+def utc_now():
+    # MongoDB naive UTC datetime wapas deta hai: saari session expiry isi mein
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def session_expiry(now=None):
+    # Broker session IST raat 23:59 tak (server UTC pe ho tab bhi)
+    now = now or datetime.now(IST)
+    return now.astimezone(IST).replace(hour=SESSION_EXPIRY_HOUR, minute=59, second=0, microsecond=0).astimezone(timezone.utc).replace(tzinfo=None)
+
+def save_session(cid, client):
+    # Persistence off (SESSION_KEY nahi) to kuch track nahi karna
+    cipher = session_cipher()
+    if not cipher: return
+    expiry = session_expiry()
+    SAVED_SESSIONS[cid] = {"Expiry": expiry, "Warned": False}
+    try:
+        conf = client.configuration
+        state = {k: getattr(conf, k) for k in SESSION_FIELDS if getattr(conf, k, None) is not None}
+        blob = cipher.encrypt(json.dumps(state, default=str).encode()).decode()
+        sessions_col.update_one({"ChatID": str(cid)}, {"$set": {"Blob": blob, "Expiry": expiry, "Saved": utc_now()}}, upsert=True)
+    except Exception as e: print(f"Session Save Error: {e}")
+
+def drop_session(cid):
+    USER_SESSIONS.pop(cid, None)
+    SAVED_SESSIONS.pop(cid, None)
+    try: sessions_col.delete_one({"ChatID": str(cid)})
+    except Exception as e: print(f"Session Delete Error: {e}")
+
+def load_sessions():
+    if not session_cipher(): return
+    try:
+        for row in sessions_col.find({"Expiry": {"$gt": utc_now()}}):
+            SAVED_SESSIONS[int(row['ChatID'])] = {"Expiry": row['Expiry'], "Blob": row['Blob'], "Warned": False}
+    except Exception as e: print(f"Session Load Error: {e}")
+
+def restore_session(cid):
+    saved = SAVED_SESSIONS.get(cid)
+    if not saved or "Blob" not in saved or cid not in USER_DETAILS: return None
+    if saved["Expiry"] <= utc_now():
+        drop_session(cid)
+        return None
+    try:
+        state = json.loads(session_cipher().decrypt(saved.pop("Blob").encode()))
+        u = USER_DETAILS[cid]
+        cl = NeoAPI(consumer_key=u.get('Key', u.get('ConsumerKey')), environment='prod')
+        for k, v in state.items(): setattr(cl.configuration, k, v)
+        USER_SESSIONS[cid] = instrument_client(cl)
+        print(f"♻️ Session restored: {cid}")
+        start_order_feed(cid)
+        return cl
+    except Exception as e:
+        print(f"Session Restore Error ({cid}): {e}")
+        drop_session(cid)
+        return None
+
+def has_session(cid):
+    if cid in USER_SESSIONS: return True
+    with SESSION_LOCK:
+        return cid in USER_SESSIONS or restore_session(cid) is not None
+
+def session_keeper_step():
+    # TOTP ke bina renew possible nahi: expiry se pehle user ko re-login bolo, expire pe drop
+    now = utc_now()
+    for cid in list(SAVED_SESSIONS.keys()):
+        saved = SAVED_SESSIONS.get(cid)
+        if not saved: continue
+        left = (saved["Expiry"] - now).total_seconds()
+        if left <= 0:
+            drop_session(cid)
+            try: bot.send_message(cid, "⌛ Session expired. Login again.", reply_markup=get_login_btn())
+            except Exception: pass
+        elif left <= SESSION_WARN and not saved["Warned"] and (cid in USER_SESSIONS or find_open_trades(cid)):
+            saved["Warned"] = True
+            try: bot.send_message(cid, f"⚠️ Session expires in {int(left // 60)} min. /login with a fresh TOTP to keep SL monitoring alive.")
+            except Exception: pass
+
+def session_keeper():
+    while True:
+        session_keeper_step()
+        time.sleep(SESSION_CHECK_INTERVAL)
+
 def log_trade(cid, idx_name, trade_symbol, token, opt_type, side, qty, price, order_id):
     new_row = {
         "ChatID": str(cid), "Index": idx_name,
         "Date": datetime.now().strftime("%Y-%m-%d"), "Time": datetime.now().strftime("%H:%M:%S"),
         "TradeSymbol": trade_symbol, "Token": token, "Type": opt_type, "Side": side,
         "Qty": int(qty), "EntryPrice": price, "ExitPrice": 0, "Status": "OPEN", 
-        "OrderID": str(order_id), "SLOrderID": "", "SLPrice": 0
+        "OrderID": str(order_id), "SLOrderID": "", "SLPrice": 0, "_id": ObjectId()
     }
     try:
-        trades_col.insert_one(new_row)
+        # Book mein turant, MongoDB mein write-behind
+        with POSITIONS_LOCK:
+            POSITIONS.setdefault(int(cid), {})[new_row["_id"]] = new_row
+            POSITION_OWNER[new_row["_id"]] = int(cid)
+        TRADE_WRITES.put(InsertOne(dict(new_row)))
     except Exception as e: print(f"Log Error: {e}")
 
+# --- Trades repository (indexed queries, projections, bulk writes) ---
+TRADE_FIELDS = {"ChatID": 1, "Index": 1, "TradeSymbol": 1, "Token": 1, "Type": 1, "Side": 1, "Qty": 1,
+                "EntryPrice": 1, "Status": 1, "OrderID": 1, "SLOrderID": 1, "SLPrice": 1}
+NO_SL = ["", "nan", None]
+
+def ensure_trade_indexes():
+    try:
+        trades_col.create_index([("ChatID", 1), ("Status", 1), ("Side", 1)], name="chat_status_side")
+        trades_col.create_index([("Status", 1), ("SLOrderID", 1)], name="status_sl")
+        trades_col.create_index([("OrderID", 1)], name="order_id")
+    except Exception as e: print(f"Index Error: {e}")
+
+# --- Open positions book: reads memory se, writes MongoDB mein write-behind ---
+POSITIONS = {}
+POSITION_OWNER = {}
+POSITIONS_LOCK = threading.RLock()
+TRADE_WRITES = queue.Queue()
+TRADE_BACKLOG = []
+TRADE_FLUSH_INTERVAL = 0.5
+# Worker steps ka max blocking wait (asyncio.run ka executor shutdown isse zyada nahi rukega)
+WORKER_WAIT = 1
+
+def load_positions():
+    try:
+        book, owner = {}, {}
+        for row in trades_col.find({"Status": "OPEN"}):
+            cid = int(row.get('ChatID', 0))
+            book.setdefault(cid, {})[row["_id"]] = row
+            owner[row["_id"]] = cid
+        with POSITIONS_LOCK:
+            POSITIONS.clear(); POSITIONS.update(book)
+            POSITION_OWNER.clear(); POSITION_OWNER.update(owner)
+    except Exception as e: print(f"Positions Load Error: {e}")
+
+def load_state():
+    # Startup pe hi (import pe nahi) taaki backtest/bench bina MongoDB ke import kar sakein
+    load_users()
+    load_sessions()
+    ensure_trade_indexes()
+    load_positions()
+
+def open_rows(cid=None):
+    with POSITIONS_LOCK:
+        if cid is not None: return list(POSITIONS.get(int(cid), {}).values())
+        return [r for rows in POSITIONS.values() for r in rows.values()]
+
+def apply_trade_update(_id, fields):
+    # Lock ke andar call karein
+    cid = POSITION_OWNER.get(_id)
+    row = POSITIONS.get(cid, {}).get(_id) if cid is not None else None
+    if row is None: return None
+    row.update(fields)
+    if row.get("Status") != "OPEN":
+        del POSITIONS[cid][_id]
+        del POSITION_OWNER[_id]
+    return row
+
+def find_open_trades(cid=None, side=None, idx_name=None, with_sl=False):
+    rows = [dict(r) for r in open_rows(cid)]
+    if side: rows = [r for r in rows if r['Side'] == side]
+    if idx_name: rows = [r for r in rows if r['Index'] == idx_name]
+    if with_sl: rows = [r for r in rows if r.get('SLOrderID') not in NO_SL]
+    return rows
+
+def find_trade(order_id=None, sl_order_id=None, open_only=False, fields=TRADE_FIELDS):
+    key, val = ("OrderID", str(order_id)) if order_id is not None else ("SLOrderID", str(sl_order_id))
+    for r in open_rows():
+        if str(r.get(key)) == val: return dict(r)
+    if open_only: return None
+    return trades_col.find_one({key: val}, fields)
+
+def update_trade(_id, fields, match=None):
+    with POSITIONS_LOCK:
+        cid = POSITION_OWNER.get(_id)
+        row = POSITIONS.get(cid, {}).get(_id)
+        if row is not None and any(row.get(k) != v for k, v in (match or {}).items()): return False
+        apply_trade_update(_id, fields)
+    TRADE_WRITES.put(UpdateOne({"_id": _id, **(match or {})}, {"$set": fields}))
+    return True
+
+def claim_trade(_id, fields):
+    # Sirf OPEN row update ho: do jagah se same event aaye to bhi ek hi baar
+    with POSITIONS_LOCK:
+        row = apply_trade_update(_id, fields)
+    if row is None: return None
+    TRADE_WRITES.put(UpdateOne({"_id": _id}, {"$set": fields}))
+    return row
+
+def reopen_trade(row):
+    fields = {"Status": "OPEN", "ExitPrice": 0, "ExitOrderID": ""}
+    with POSITIONS_LOCK:
+        cid = int(row['ChatID'])
+        POSITIONS.setdefault(cid, {})[row["_id"]] = {**row, **fields}
+        POSITION_OWNER[row["_id"]] = cid
+    TRADE_WRITES.put(UpdateOne({"_id": row["_id"]}, {"$set": fields}))
+
+def bulk_update_trades(updates):
+    with POSITIONS_LOCK:
+        for _id, fields in updates: apply_trade_update(_id, fields)
+    for _id, fields in updates: TRADE_WRITES.put(UpdateOne({"_id": _id}, {"$set": fields}))
+    return len(updates)
+
+def trade_writer_step():
+    # Bounded wait: async mode mein to_thread ko shutdown pe atakna nahi chahiye
+    # Pichli baar ke bache ops (MongoDB down tha) pehle, order same
+    ops = TRADE_BACKLOG[:]
+    del TRADE_BACKLOG[:]
+    if not ops:
+        try: ops = [TRADE_WRITES.get(timeout=WORKER_WAIT)]
+        except queue.Empty: return
+        time.sleep(TRADE_FLUSH_INTERVAL)
+    while not TRADE_WRITES.empty(): ops.append(TRADE_WRITES.get_nowait())
+    # Ordered: insert pehle, uske updates baad mein
+    while ops:
+        try:
+            trades_col.bulk_write(ops, ordered=True)
+            return
+        except BulkWriteError as e:
+            errs = e.details.get("writeErrors") or []
+            if not errs:
+                # Sirf write concern error: kya likha pata nahi, poora batch dobara (duplicate insert skip ho jayega)
+                metric_inc("opbot_errors_total", where="trade_writer")
+                print(f"Trade Writer Error: {e.details.get('writeConcernErrors')}")
+                TRADE_BACKLOG.extend(ops)
+                time.sleep(WORKER_WAIT)
+                return
+            err = errs[0]
+            # index se pehle wale likh gaye; duplicate insert = pehle hi likha tha, baaki error wala op drop (log)
+            if err.get("code") != 11000:
+                metric_inc("opbot_trade_writes_dropped_total")
+                print(f"Trade Writer: dropped {ops[err['index']]} ({err.get('errmsg')})")
+            ops = ops[err["index"] + 1:]
+        except Exception as e:
+            # Connection/timeout: kuch nahi khoya, agli step mein retry
+            metric_inc("opbot_errors_total", where="trade_writer")
+            print(f"Trade Writer Error: {e}")
+            TRADE_BACKLOG.extend(ops)
+            time.sleep(WORKER_WAIT)
+            return
+
+def trade_writer():
+    # Writer thread kabhi nahi marna chahiye (warna saare trades sirf memory mein)
+    while True:
+        try: trade_writer_step()
+        except Exception as e:
+            metric_inc("opbot_errors_total", where="trade_writer")
+            print(f"Trade Writer Error: {e}")
+            time.sleep(WORKER_WAIT)
+
 def format_crore_lakh(number):
     val = abs(number)
     if val >= 10000000: return f"{number / 10000000:.2f} Cr"
@@ -106,6 +579,414 @@ def format_crore_lakh(number):
 # =========================================
 # --- 2. DATA ENGINE & MONITOR ---
 # =========================================
+def parse_ref_key(ref_key):
+    m = REF_KEY_RE.match(ref_key)
+    if not m: return None
+    strike = float(m.group(3))
+    if strike.is_integer(): strike = int(strike)
+    return m.group(1), m.group(2), strike, m.group(4)
+
+def load_master(idx_name):
+    rows, by_symbol, by_ref, chains = [], {}, {}, {}
+    cursor = fo_master_col.find({"IndexName": idx_name}, {"_id": 0, "0": 1, "5": 1, "7": 1})
+    for r in cursor:
+        try:
+            token = str(int(float(r.get("0"))))
+        except (TypeError, ValueError):
+            continue
+        rec = {"Token": token, "TradeSymbol": str(r.get("5", "")).strip(), "RefKey": str(r.get("7", "")).strip()}
+        rows.append(rec)
+        by_symbol[rec["TradeSymbol"]] = rec
+        by_ref[rec["RefKey"]] = rec
+        parsed = parse_ref_key(rec["RefKey"])
+        if not parsed or parsed[0] != idx_name: continue
+        _, exp, strike, opt_type = parsed
+        rec.update({"Expiry": exp, "Strike": strike, "Type": opt_type})
+        chains.setdefault(exp, {}).setdefault(strike, {})[opt_type] = rec
+    # Expiry calendar: sorted dates + monthly (har mahine ki last expiry)
+    calendar = []
+    for exp in chains:
+        try: calendar.append((datetime.strptime(exp, "%d%b%y").date(), exp))
+        except ValueError: continue
+    calendar.sort()
+    monthly = {}
+    for d, exp in calendar: monthly[(d.year, d.month)] = exp
+    cache = {"Date": datetime.now().strftime("%Y-%m-%d"), "Rows": rows,
+             "BySymbol": by_symbol, "ByRefKey": by_ref, "Chains": chains,
+             "ExpiryDates": [d for d, _ in calendar], "Expiries": [e for _, e in calendar],
+             "Monthly": set(monthly.values())}
+    MASTER_CACHE[idx_name] = cache
+    print(f"📦 Master cached: {idx_name} ({len(rows)} rows)")
+    return cache
+
+def get_master(idx_name, refresh=False):
+    today = datetime.now().strftime("%Y-%m-%d")
+    cache = MASTER_CACHE.get(idx_name)
+    if refresh or not cache or cache["Date"] != today:
+        with MASTER_LOCK:
+            cache = MASTER_CACHE.get(idx_name)
+            if refresh or not cache or cache["Date"] != today:
+                cache = load_master(idx_name)
+    return cache
+
+def find_expiry(idx_name, atm=None, mode="NEAR", on_date=None):
+    master = get_master(idx_name)
+    day = (on_date or datetime.now()).date()
+    i = bisect.bisect_left(master["ExpiryDates"], day)
+    skip = 1 if mode == "NEXT" else 0
+    for exp in master["Expiries"][i:]:
+        if mode == "MONTHLY" and exp not in master["Monthly"]: continue
+        if atm is not None and "CE" not in master["Chains"][exp].get(atm, {}): continue
+        if skip: 
+            skip -= 1
+            continue
+        return exp
+    return None
+
+def refresh_master(idx_name=None):
+    for name in ([idx_name] if idx_name else list(INDICES_CONFIG.keys())):
+        get_master(name, refresh=True)
+
+def ensure_master_indexes():
+    try:
+        fo_master_col.create_index([("IndexName", 1), ("Type", 1), ("Expiry", 1)], name="index_type_expiry")
+        fo_master_col.create_index([("0", 1)], name="token")
+    except Exception as e: print(f"Master Index Error: {e}")
+
+def scrip_master_urls(client=None):
+    if SCRIP_MASTER_URLS: return SCRIP_MASTER_URLS
+    if client is None: return []
+    urls = []
+    for seg in dict.fromkeys(conf["Exchange"] for conf in INDICES_CONFIG.values()):
+        resp = client.scrip_master(exchange_segment=seg)
+        if isinstance(resp, str): urls.append(resp)
+        elif isinstance(resp, dict): urls += [u for u in resp.get("filesPaths", []) if u.rstrip("/").endswith(f"{seg}.csv")]
+    return urls
+
+def stream_csv_chunks(url, size=INGEST_CHUNK):
+    # Poori file memory mein nahi: lines stream, INGEST_CHUNK rows ke chunks
+    with requests.get(url, stream=True, timeout=60) as resp:
+        resp.raise_for_status()
+        reader = csv.reader(line.decode("utf-8", "ignore") for line in resp.iter_lines(chunk_size=1 << 16) if line)
+        header = next(reader, None)
+        if header is None: return
+        names = [h.strip().rstrip(";") for h in header]
+        if SCRIP_COLS["0"] in names: cols, chunk = {k: names.index(v) for k, v in SCRIP_COLS.items() if v in names}, []
+        else: cols, chunk = {k: int(k) for k in SCRIP_COLS if k.isdigit()}, [header]
+        for row in reader:
+            chunk.append(row)
+            if len(chunk) >= size:
+                yield cols, chunk
+                chunk = []
+        if chunk: yield cols, chunk
+
+def normalize_scrip(row, cols):
+    get = lambda k: row[cols[k]].strip() if k in cols and cols[k] < len(row) else ""
+    # Sasta filter pehle: baaki F&O (stocks, BANKNIFTY...) ke lakhon rows yahin skip
+    inst, symbol = get("3").upper(), get("5")
+    idx_name = get("4").upper() or re.match(r"^[A-Z]*", symbol).group(0)
+    if idx_name not in INDICES_CONFIG or (inst and inst not in ("OPTIDX", "FUTIDX")): return None
+    ref_key = get("7")
+    parsed = parse_ref_key(ref_key)
+    exchange = get("2") or INDICES_CONFIG[idx_name]["Exchange"]
+    if exchange != INDICES_CONFIG[idx_name]["Exchange"]: return None
+    if parsed and parsed[0] == idx_name: _, expiry, strike, opt_type = parsed
+    elif inst == "FUTIDX" or symbol.endswith("FUT"): expiry, strike, opt_type = None, None, "FUT"
+    else: return None
+    try: token, lot = str(int(float(get("0")))), int(float(get("Lot") or 0))
+    except ValueError: return None
+    return {"0": token, "5": symbol, "7": ref_key, "IndexName": idx_name, "Exchange": exchange,
+            "InstType": inst or ("FUTIDX" if opt_type == "FUT" else "OPTIDX"), "Type": opt_type,
+            "Strike": strike, "Expiry": expiry, "LotSize": lot}
+
+@timed("opbot_master_ingest")
+def ingest_master(client=None, urls=None):
+    urls = urls or scrip_master_urls(client)
+    if not urls: return False, "❌ No scrip master URL (SCRIP_MASTER_URLS set karein ya login karein)"
+    # Existing contracts ka diff base (sirf NIFTY/SENSEX, chhota set)
+    existing, dupes = {}, []
+    for r in fo_master_col.find({"IndexName": {"$in": list(INDICES_CONFIG)}}, {f: 1 for f in ("0", "IndexName") + MASTER_FIELDS}):
+        try: tk = str(int(float(r.get("0"))))
+        except (TypeError, ValueError):
+            dupes.append(r["_id"])
+            continue
+        if tk in existing: dupes.append(existing[tk]["_id"])
+        existing[tk] = r
+    seen, indices, changed, ops = set(), set(), set(), []
+    stats = {"Rows": 0, "Kept": 0, "Upserts": 0, "Deleted": 0, "Chains": 0}
+    for url in urls:
+        for cols, chunk in stream_csv_chunks(url):
+            stats["Rows"] += len(chunk)
+            for row in chunk:
+                doc = normalize_scrip(row, cols)
+                if not doc or doc["0"] in seen: continue
+                seen.add(doc["0"]); indices.add(doc["IndexName"])
+                old = existing.get(doc["0"])
+                if old and all(old.get(f) == doc[f] for f in MASTER_FIELDS): continue
+                ops.append(UpdateOne({"_id": old["_id"]} if old else {"0": doc["0"]}, {"$set": doc}, upsert=True))
+                changed.add(doc["0"])
+            if len(ops) >= INGEST_CHUNK:
+                fo_master_col.bulk_write(ops, ordered=False)
+                stats["Upserts"] += len(ops); ops = []
+    if ops:
+        fo_master_col.bulk_write(ops, ordered=False)
+        stats["Upserts"] += len(ops)
+    stats["Kept"] = len(seen)
+    # Expired contracts (sirf un indices ke jinki file aayi) + duplicates hatao
+    gone = {tk for tk, r in existing.items() if tk not in seen and r.get("IndexName") in indices}
+    stale = dupes + [existing[tk]["_id"] for tk in gone]
+    if stale:
+        fo_master_col.delete_many({"_id": {"$in": stale}})
+        stats["Deleted"] = len(stale)
+    ensure_master_indexes()
+    # Purana cache hatao; jin chains mein contract badla/hata ya expiry hi nahi rahi unko next fetch pe naya banne do
+    for name in indices: MASTER_CACHE.pop(name, None)
+    refresh_master()
+    changed |= gone
+    for cid, chain in list(ACTIVE_TOKENS.items()):
+        idx_name = USER_SETTINGS.get(cid, {}).get("Index")
+        if not chain or idx_name not in indices: continue
+        if chain.expiry not in MASTER_CACHE.get(idx_name, {}).get("Chains", {}) or not changed.isdisjoint(chain.token_list):
+            ACTIVE_TOKENS[cid] = []
+            stats["Chains"] += 1
+    INGEST_STATE["Date"] = datetime.now(IST).strftime("%Y-%m-%d")
+    return True, stats
+
+def master_ingest_step():
+    # Din mein ek baar, INGEST_HOUR (IST) ke baad (URL env se ya kisi bhi logged-in session se)
+    now = datetime.now(IST)
+    if INGEST_STATE["Date"] == now.strftime("%Y-%m-%d") or now.hour < INGEST_HOUR: return
+    client = next(iter(USER_SESSIONS.values()), None)
+    if not SCRIP_MASTER_URLS and client is None: return
+    try:
+        ok, stats = ingest_master(client)
+        print(f"📦 Master ingest: {stats}")
+    except Exception as e:
+        metric_inc("opbot_errors_total", where="master_ingest")
+        print(f"Master Ingest Error: {e}")
+
+def master_ingester():
+    while True:
+        master_ingest_step()
+        time.sleep(SESSION_CHECK_INTERVAL)
+
+def record_open_oi(tokens, oi):
+    today = datetime.now().strftime("%Y-%m-%d")
+    if OPEN_OI["Date"] != today: OPEN_OI.update({"Date": today, "OI": {}})
+    book = OPEN_OI["OI"]
+    for tk, v in zip(tokens, oi):
+        if v > 0 and tk not in book: book[tk] = int(v)
+
+class OptionChain:
+    # Typed arrays, strike order mein (har strike pe CE phir PE)
+    def __init__(self, records, atm=None, expiry=None):
+        self.atm, self.expiry = atm, expiry
+        self.symbols = [r["TradeSymbol"] for r in records]
+        self.ref_keys = [r["RefKey"] for r in records]
+        self.token_list = [r["Token"] for r in records]
+        self.tokens = np.array([int(tk) for tk in self.token_list], dtype=np.int64)
+        self.strikes = np.array([r["Strike"] for r in records], dtype=np.float64)
+        self.is_ce = np.array([r["Type"] == "CE" for r in records], dtype=bool)
+        self.is_pe = ~self.is_ce
+        self.ltp = np.zeros(len(records), dtype=np.float64)
+        self.oi = np.zeros(len(records), dtype=np.int64)
+        self.index = {tk: i for i, tk in enumerate(self.token_list)}
+        # Strike ladder + har row ka ladder position (prefix sums isi order mein)
+        self.ladder = np.unique(self.strikes)
+        self.pos = np.searchsorted(self.ladder, self.strikes)
+        self.atm_i = int(np.argmin(np.abs(self.ladder - float(atm)))) if atm is not None and len(self.ladder) else len(self.ladder) // 2
+        self.dirty = True
+
+    def __len__(self):
+        return len(self.token_list)
+
+    def update(self, live_map):
+        quotes = [live_map.get(tk) for tk in self.token_list]
+        self.ltp[:] = [d['ltp'] if d else 0.0 for d in quotes]
+        self.oi[:] = [d['oi'] if d else 0 for d in quotes]
+        record_open_oi(self.token_list, self.oi)
+        self.refresh_stats()
+
+    def update_tick(self, token, ltp=None, oi=None):
+        i = self.index.get(token)
+        if i is None: return False
+        if ltp is not None: self.ltp[i] = ltp
+        if oi is not None:
+            self.oi[i] = oi
+            self.dirty = True
+        return True
+
+    def refresh_stats(self):
+        m = len(self.ladder)
+        ce_oi, pe_oi = np.zeros(m, dtype=np.int64), np.zeros(m, dtype=np.int64)
+        ce_oi[self.pos[self.is_ce]] = self.oi[self.is_ce]
+        pe_oi[self.pos[self.is_pe]] = self.oi[self.is_pe]
+        base = OPEN_OI["OI"]
+        open_oi = np.array([base.get(tk, v) for tk, v in zip(self.token_list, self.oi)], dtype=np.int64)
+        ce_chg, pe_chg = np.zeros(m, dtype=np.int64), np.zeros(m, dtype=np.int64)
+        ce_chg[self.pos[self.is_ce]] = (self.oi - open_oi)[self.is_ce]
+        pe_chg[self.pos[self.is_pe]] = (self.oi - open_oi)[self.is_pe]
+        zero = np.zeros(1, dtype=np.int64)
+        self.cum_ce, self.cum_pe = np.concatenate((zero, np.cumsum(ce_oi))), np.concatenate((zero, np.cumsum(pe_oi)))
+        self.cum_ce_chg, self.cum_pe_chg = np.concatenate((zero, np.cumsum(ce_chg))), np.concatenate((zero, np.cumsum(pe_chg)))
+        # Max pain: har settlement strike pe writers ka total payout, sabse kam wala
+        settle = self.ladder[:, None]
+        pain = (np.maximum(settle - self.ladder, 0) * ce_oi).sum(axis=1) + (np.maximum(self.ladder - settle, 0) * pe_oi).sum(axis=1)
+        self.max_pain = float(self.ladder[int(np.argmin(pain))]) if m and pain.any() else None
+        self.dirty = False
+
+    def oi_range(self, n):
+        # ATM se neeche n strikes PE (support), upar n strikes CE (resistance)
+        if self.dirty: self.refresh_stats()
+        lo, hi = max(0, self.atm_i - n), min(len(self.ladder), self.atm_i + n + 1)
+        pe = int(self.cum_pe[self.atm_i + 1] - self.cum_pe[lo])
+        ce = int(self.cum_ce[hi] - self.cum_ce[self.atm_i])
+        pe_chg = int(self.cum_pe_chg[self.atm_i + 1] - self.cum_pe_chg[lo])
+        ce_chg = int(self.cum_ce_chg[hi] - self.cum_ce_chg[self.atm_i])
+        return {"PE": pe, "CE": ce, "Diff": pe - ce, "PCR": pe / ce if ce else 0.0, "PEChg": pe_chg, "CEChg": ce_chg}
+
+    def pcr(self):
+        if self.dirty: self.refresh_stats()
+        return float(self.cum_pe[-1] / self.cum_ce[-1]) if self.cum_ce[-1] else 0.0
+
+    def row(self, i):
+        stk = float(self.strikes[i])
+        return {"TradeSymbol": self.symbols[i], "RefKey": self.ref_keys[i], "Token": self.token_list[i],
+                "Type": "CE" if self.is_ce[i] else "PE", "Strike": int(stk) if stk.is_integer() else stk,
+                "LTP": float(self.ltp[i]), "OI": int(self.oi[i])}
+
+class SnapshotStore:
+    def __init__(self, root, window=SNAPSHOT_WINDOW, gap=SNAPSHOT_GAP):
+        self.root, self.window, self.gap = root, window, gap
+        self.mem = {}
+        self.meta = {}
+        self.lock = threading.Lock()
+
+    def path(self, key, ts):
+        idx_name, expiry = key
+        return os.path.join(self.root, f"{datetime.fromtimestamp(ts, IST).strftime('%Y%m%d')}_{idx_name}_{expiry}.bin")
+
+    def append(self, key, quotes, ts=None):
+        # Expiry nahi (sirf positions wala key) = replay ke kaam ka nahi
+        if not key[1]: return False
+        ts = ts or time.time()
+        with self.lock:
+            buf = self.mem.setdefault(key, deque())
+            if buf and ts - buf[-1]["time"][0] < self.gap: return False
+        rec = np.empty(len(quotes), dtype=SNAP_DTYPE)
+        rec["time"] = ts
+        rec["token"] = np.fromiter((int(tk) for tk in quotes), dtype=np.int64, count=len(quotes))
+        rec["ltp"] = np.fromiter((d['ltp'] for d in quotes.values()), dtype=np.float32, count=len(quotes))
+        rec["oi"] = np.fromiter((d['oi'] for d in quotes.values()), dtype=np.int64, count=len(quotes))
+        with self.lock:
+            buf.append(rec)
+            while len(buf) > self.window: buf.popleft()
+        # Write-through: poora din disk pe (backtest/replay isi se)
+        self.spill(key, rec)
+        return True
+
+    def spill(self, key, rec):
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            with open(self.path(key, rec["time"][0]), "ab") as f: rec.tofile(f)
+        except Exception as e: print(f"Snapshot Spill Error: {e}")
+
+    def describe(self, key, records):
+        # Din ki .json: token -> [symbol, strike, type] (replay mein chain dobara banane ke liye)
+        path = self.path(key, time.time())[:-4] + ".json"
+        with self.lock:
+            meta = self.meta.get(key)
+            if not meta or meta["Path"] != path:
+                rows = {}
+                try:
+                    if os.path.exists(path):
+                        with open(path) as f: rows = json.load(f)
+                except Exception as e: print(f"Snapshot Meta Error: {e}")
+                meta = self.meta[key] = {"Path": path, "Rows": rows}
+            new = {r["Token"]: [r["TradeSymbol"], r["Strike"], r["Type"]] for r in records if r["Token"] not in meta["Rows"]}
+            if not new: return False
+            meta["Rows"].update(new)
+            rows = dict(meta["Rows"])
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            with open(path, "w") as f: json.dump(rows, f)
+        except Exception as e: print(f"Snapshot Meta Error: {e}")
+        return True
+
+    def disk(self, key, ts):
+        path = self.path(key, ts)
+        if not os.path.exists(path) or os.path.getsize(path) < SNAP_DTYPE.itemsize: return None
+        return np.memmap(path, dtype=SNAP_DTYPE, mode="r")
+
+    def at(self, key, ts):
+        # ts ke baad ka pehla snapshot (memory, warna disk)
+        with self.lock: buf = list(self.mem.get(key, ()))
+        if buf and buf[0]["time"][0] <= ts:
+            i = bisect.bisect_left([r["time"][0] for r in buf], ts)
+            return buf[i] if i < len(buf) else buf[-1]
+        mm = self.disk(key, ts)
+        if mm is not None:
+            i = int(np.searchsorted(mm["time"], ts))
+            if i < len(mm):
+                j = int(np.searchsorted(mm["time"], mm["time"][i], side="right"))
+                return np.array(mm[i:j])
+        return buf[0] if buf else None
+
+    def latest(self, key):
+        with self.lock:
+            buf = self.mem.get(key)
+            return buf[-1] if buf else None
+
+    def change_since(self, key, ts):
+        old, new = self.at(key, ts), self.latest(key)
+        if old is None or new is None: return None, {}
+        base = {int(t): (float(l), int(o)) for t, l, o in zip(old["token"], old["ltp"], old["oi"])}
+        chg = {}
+        for t, l, o in zip(new["token"], new["ltp"], new["oi"]):
+            if int(t) in base:
+                b = base[int(t)]
+                chg[str(int(t))] = {"ltp": float(l) - b[0], "oi": int(o) - b[1]}
+        return float(old["time"][0]), chg
+
+SNAPSHOTS = SnapshotStore(SNAPSHOT_DIR)
+
+def chain_deltas(chain):
+    # Delta proxy: |dLTP/dStrike| har side pe (IV ke bina, chain se hi)
+    delta = np.zeros(len(chain), dtype=np.float64)
+    for mask in (chain.is_ce, chain.is_pe):
+        idx = np.flatnonzero(mask & (chain.ltp > 0))
+        if len(idx) > 1: delta[idx] = np.abs(np.gradient(chain.ltp[idx], chain.strikes[idx]))
+    return np.clip(delta, 0, 1)
+
+def rank_main(chain, opt_type, target, top=5):
+    valid = (chain.is_ce if opt_type == 'CE' else chain.is_pe) & (chain.ltp > 0)
+    idx = np.flatnonzero(valid & (chain.ltp <= target))
+    # Target se neeche koi nahi mila to sabse sasta
+    if len(idx): return idx[np.argsort(-chain.ltp[idx], kind="stable")][:top]
+    idx = np.flatnonzero(valid)
+    return idx[np.argsort(chain.ltp[idx], kind="stable")][:top]
+
+def rank_hedges(chain, main_i, mode="RATIO", value=HEDGE_RATIO, top=5):
+    opt_ce = bool(chain.is_ce[main_i])
+    side = chain.is_ce if opt_ce else chain.is_pe
+    beyond = chain.strikes > chain.strikes[main_i] if opt_ce else chain.strikes < chain.strikes[main_i]
+    idx = np.flatnonzero(side & beyond & (chain.ltp > 0))
+    if not len(idx): return idx
+    if mode == "DIST":
+        target = chain.strikes[main_i] + (value if opt_ce else -value)
+        score = np.abs(chain.strikes[idx] - target)
+    elif mode == "DELTA":
+        score = np.abs(chain_deltas(chain)[idx] - value)
+    else:
+        score = np.abs(chain.ltp[idx] - chain.ltp[main_i] * value)
+    return idx[np.lexsort((chain.ltp[idx], score))][:top]
+
+def pick_trade(chain, opt_type, target, mode="RATIO", value=HEDGE_RATIO, top=5):
+    mains = rank_main(chain, opt_type, target, top)
+    if not len(mains): return None, []
+    return chain.row(int(mains[0])), [chain.row(int(i)) for i in rank_hedges(chain, int(mains[0]), mode, value, top)]
+
+@timed("opbot_chain_build")
 def auto_generate_chain(cid):
     idx_name = USER_SETTINGS[cid]["Index"]
     conf = INDICES_CONFIG[idx_name]
@@ -118,20 +999,16 @@ def auto_generate_chain(cid):
     search_sym = f"{idx_name}{yy}{mon}FUT"
     
     try:
-        # Direct query from MongoDB
-        cursor = fo_master_col.find({"IndexName": idx_name})
-        df = pd.DataFrame(list(cursor))
+        master = get_master(idx_name)
         
-        if df.empty or "5" not in df.columns.astype(str):
+        if not master["Rows"]:
             return False, "❌ Master Data Empty in MongoDB. Data theek se upload nahi hua."
 
-        df.columns = df.columns.astype(str)
-        row = df[df["5"] == search_sym]
+        fut = master["BySymbol"].get(search_sym)
         
-        if row.empty: return False, f"❌ Future Not Found: {search_sym}"
+        if not fut: return False, f"❌ Future Not Found: {search_sym}"
         
-        # Safe float conversion
-        fut_token = str(int(float(row.iloc[0]["0"])))
+        fut_token = fut["Token"]
         
         q = client.quotes(instrument_tokens=[{"instrument_token": fut_token, "exchange_segment": conf["Exchange"]}], quote_type="all")
         ltp = 0
@@ -143,127 +1020,749 @@ def auto_generate_chain(cid):
         
         atm = round(ltp / conf["StrikeGap"]) * conf["StrikeGap"]
         USER_SETTINGS[cid]["ATM"] = f"{atm}"
-        expiry_date_str = None
-        all_ref_keys = set(df["7"].astype(str).values) 
-        
-        # SMART EXPIRY FINDER: '.00' aur bina '.00' dono check karega
-        for i in range(0, 45):
-            test_date = now + timedelta(days=i)
-            d_str = f"{test_date.strftime('%d')}{test_date.strftime('%b').upper()}{test_date.strftime('%y')}"
-            
-            check_sym_1 = f"{idx_name}{d_str}{atm}.00CE"
-            check_sym_2 = f"{idx_name}{d_str}{atm}CE" 
-            
-            if check_sym_1 in all_ref_keys or check_sym_2 in all_ref_keys:
-                expiry_date_str = d_str
-                break
+        expiry_date_str = find_expiry(idx_name, atm, USER_SETTINGS[cid].get("ExpiryMode", "NEAR"), now)
                 
         if not expiry_date_str: return False, f"❌ Expiry Not Found for ATM {atm}"
         
-        prefix = f"{idx_name}{expiry_date_str}"
-        relevant = df[df["7"].str.startswith(prefix, na=False)]
+        chain = master["Chains"].get(expiry_date_str, {})
         strikes = [atm + (i * conf["StrikeGap"]) for i in range(-50, 51)]
         new_list = []
         
-        for index, r in relevant.iterrows():
-            ref_key = str(r["7"]).strip()
-            trd_sym = str(r["5"]).strip()
-            token = str(int(float(r["0"])))
-            for stk in strikes:
-                if f"{stk}.00CE" in ref_key or f"{stk}CE" in ref_key:
-                     new_list.append({"TradeSymbol": trd_sym, "RefKey": ref_key, "Token": token, "Type": "CE", "Strike": stk, "LTP": 0.0, "OI": 0})
-                elif f"{stk}.00PE" in ref_key or f"{stk}PE" in ref_key:
-                     new_list.append({"TradeSymbol": trd_sym, "RefKey": ref_key, "Token": token, "Type": "PE", "Strike": stk, "LTP": 0.0, "OI": 0})
+        for stk in strikes:
+            legs = chain.get(stk)
+            if not legs: continue
+            for opt_type in ("CE", "PE"):
+                r = legs.get(opt_type)
+                if r:
+                    new_list.append({"TradeSymbol": r["TradeSymbol"], "RefKey": r["RefKey"], "Token": r["Token"], "Type": opt_type, "Strike": stk, "LTP": 0.0, "OI": 0})
                      
         if not new_list:
             return False, "❌ Strikes list empty reh gayi. Master Data check karein."
             
-        ACTIVE_TOKENS[cid] = new_list
+        ACTIVE_TOKENS[cid] = OptionChain(new_list, atm, expiry_date_str)
+        SNAPSHOTS.describe((idx_name, expiry_date_str), new_list)
+        USER_SETTINGS[cid]["Expiry"] = expiry_date_str
         return True, f"ATM: {atm} | Exp: {expiry_date_str}"
         
     except Exception as e: 
         return False, f"❌ Chain Gen Error: {str(e)}"
 
-def fetch_data_for_user(cid):
+def parse_quotes(q):
+    live_map = {}
+    if not q: return live_map
+    raw = q if isinstance(q, list) else q.get('data', [])
+    for item in raw:
+        tk = str(item.get('exchange_token') or item.get('tk'))
+        ltp_val = float(item.get('ltp', item.get('lastPrice', 0)))
+        oi_val = int(item.get('open_int') or item.get('openInterest') or item.get('oi') or 0)
+        live_map[tk] = {'ltp': ltp_val, 'oi': oi_val}
+    return live_map
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        # Lock ke andar call karein
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def try_acquire(self, n=1):
+        # Bina wait: itne tokens hain to kaat lo, warna False
+        with self.lock:
+            self.refill()
+            if self.tokens < n: return False
+            self.tokens -= n
+            return True
+
+    def available(self):
+        with self.lock:
+            self.refill()
+            return self.tokens
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+BROKER_BUDGET = TokenBucket(REFRESH_BUDGET / 60, max(10, REFRESH_BUDGET / 4))
+
+def get_limiter(client):
+    with RATE_LOCK:
+        limiter = RATE_LIMITERS.get(client)
+        if limiter is None:
+            limiter = RATE_LIMITERS[client] = TokenBucket(QUOTE_RATE)
+    return limiter
+
+def quotes_with_retry(client, batch):
+    for attempt in range(QUOTE_RETRIES):
+        try:
+            get_limiter(client).acquire()
+            q = client.quotes(instrument_tokens=batch, quote_type="all")
+            if isinstance(q, dict) and (q.get('error') or q.get('Error')):
+                raise RuntimeError(q.get('error') or q.get('Error'))
+            return q
+        except Exception:
+            if attempt == QUOTE_RETRIES - 1: raise
+            time.sleep(0.25 * (2 ** attempt))
+
+def fetch_quotes(client, tokens, exchange):
+    batches = [[{"instrument_token": tk, "exchange_segment": exchange} for tk in tokens[i : i + QUOTE_BATCH]]
+               for i in range(0, len(tokens), QUOTE_BATCH)]
+    live_map = {}
+    for q in QUOTE_POOL.map(lambda b: quotes_with_retry(client, b), batches):
+        live_map.update(parse_quotes(q))
+    return live_map
+
+def poll_clients(preferred=None):
+    # Pehle user ka apna session, fail ho to koi bhi dusra valid session
+    clients = [USER_SESSIONS[preferred]] if preferred in USER_SESSIONS else []
+    clients += [c for c in list(USER_SESSIONS.values()) if c not in clients]
+    return clients
+
+def register_tokens(key, tokens):
+    with MARKET_LOCKS.setdefault(key, threading.Lock()):
+        snap = MARKET_DATA.setdefault(key, {"Tokens": set(), "Polled": set(), "Quotes": {}, "Time": 0})
+        snap["Tokens"].update(tokens)
+    return snap
+
+def on_feed_message(message, cid=None):
+    try:
+        if isinstance(message, str): message = json.loads(message)
+        for m in (message if isinstance(message, list) else [message]):
+            if not isinstance(m, dict): continue
+            data = m.get('data', [])
+            if isinstance(data, str): data = json.loads(data)
+            for item in (data if isinstance(data, list) else [data]):
+                if not isinstance(item, dict): continue
+                if item.get('nOrdNo'):
+                    on_order_update(cid, item)
+                    continue
+                tk = item.get('tk') or item.get('exchange_token')
+                if not tk: continue
+                tick = LIVE_TICKS.setdefault((item.get('e', ''), str(tk)), {'ltp': 0.0, 'oi': 0})
+                if item.get('ltp') not in (None, ''): tick['ltp'] = float(item['ltp'])
+                if item.get('oi') not in (None, ''): tick['oi'] = int(float(item['oi']))
+                tick['Time'] = FEED["LastTick"] = time.time()
+                # Active chains mein bhi seedha (OI badla to stats dirty, agli query pe rebuild)
+                ltp = float(item['ltp']) if item.get('ltp') not in (None, '') else None
+                oi = tick['oi'] if item.get('oi') not in (None, '') else None
+                for chain in list(ACTIVE_TOKENS.values()):
+                    if chain: chain.update_tick(str(tk), ltp, oi)
+                if (item.get('e', ''), str(tk)) in PNL_WATCH: on_pnl_tick((item.get('e', ''), str(tk)), tick['ltp'])
+    except Exception as e: print(f"Feed Parse Error: {e}")
+
+def on_order_update(cid, item):
+    status = str(item.get('ordSt') or item.get('status') or '').upper()
+    if status in FINAL_STATUSES:
+        oid = str(item['nOrdNo'])
+        try: price = float(item.get('avgPrc') or 0)
+        except (TypeError, ValueError): price = 0.0
+        with ORDER_LOCK:
+            ORDER_UPDATES[oid] = {"Status": status, "Price": price}
+            while len(ORDER_UPDATES) > ORDER_UPDATES_MAX: ORDER_UPDATES.pop(next(iter(ORDER_UPDATES)))
+            waiter = ORDER_WAITERS.pop(oid, None)
+        if waiter: waiter.set()
+        SL_EVENTS.put((cid, oid, status, price))
+
+def on_feed_open(cid=None):
+    if FEED["Client"] is not None and USER_SESSIONS.get(cid) is FEED["Client"]: FEED["Open"] = True
+
+def on_feed_close(cid=None):
+    # Connection gaya to subscriptions dobara karni padengi (next poll pe)
+    ORDER_FEEDS.pop(cid, None)
+    with FEED_LOCK:
+        if USER_SESSIONS.get(cid) is FEED["Client"]:
+            FEED["Open"] = False
+            FEED["Subscribed"] = set()
+
+def on_feed_error(error=None, cid=None):
+    print(f"Feed Error: {error}")
+    on_feed_close(cid)
+
+def attach_feed_callbacks(cid, client):
+    client.on_message = lambda message: on_feed_message(message, cid)
+    client.on_open = lambda message=None: on_feed_open(cid)
+    client.on_close = lambda message=None: on_feed_close(cid)
+    client.on_error = lambda error=None: on_feed_error(error, cid)
+
+def start_order_feed(cid):
+    if not STREAMING or cid not in USER_SESSIONS: return
+    client = USER_SESSIONS[cid]
+    if ORDER_FEEDS.get(cid) is client: return
+    try:
+        attach_feed_callbacks(cid, client)
+        client.subscribe_to_orderfeed()
+        ORDER_FEEDS[cid] = client
+    except Exception as e: print(f"Order Feed Error: {e}")
+
+def feed_alive():
+    # Ticks band (market closed / silent disconnect) to polling pe wapas
+    return (STREAMING and FEED["Open"] and time.time() - FEED["LastTick"] < FEED_STALE
+            and FEED["Client"] in list(USER_SESSIONS.values()))
+
+def subscribe_feed(exchange, tokens, preferred=None):
+    if not STREAMING: return
+    with FEED_LOCK:
+        client = FEED["Client"]
+        if client not in list(USER_SESSIONS.values()):
+            clients = poll_clients(preferred)
+            if not clients: return
+            client = FEED["Client"] = clients[0]
+            # Naya client: pehla tick aane tak feed live nahi maana jayega
+            FEED["Open"], FEED["Subscribed"], FEED["LastTick"] = False, set(), 0
+            attach_feed_callbacks(next(c for c, cl in USER_SESSIONS.items() if cl is client), client)
+        new = [(exchange, tk) for tk in tokens if (exchange, tk) not in FEED["Subscribed"]]
+        if not new: return
+        try:
+            client.subscribe(instrument_tokens=[{"instrument_token": tk, "exchange_segment": ex} for ex, tk in new], isIndex=False, isDepth=False)
+            FEED["Subscribed"].update(new)
+            FEED["Open"] = True
+        except Exception as e: print(f"Feed Subscribe Error: {e}")
+
+def seed_ticks(exchange, live_map):
+    now = time.time()
+    for tk, d in live_map.items():
+        tick = LIVE_TICKS.setdefault((exchange, tk), {'ltp': 0.0, 'oi': 0})
+        if 'Time' not in tick or now - tick['Time'] > QUOTE_TTL:
+            tick.update(d)
+            tick['Time'] = now
+
+def live_quotes(exchange, tokens):
+    return {tk: LIVE_TICKS[(exchange, tk)] for tk in tokens if (exchange, tk) in LIVE_TICKS}
+
+def get_market_snapshot(idx_name, expiry, tokens=(), preferred=None, max_age=QUOTE_TTL):
+    key = (idx_name, expiry)
+    exchange = INDICES_CONFIG[idx_name]["Exchange"]
+    snap = register_tokens(key, tokens)
+    with MARKET_LOCKS[key]:
+        # Streaming mode: subscribed tokens ka data seedha tick store se
+        if feed_alive() and {(exchange, tk) for tk in snap["Tokens"]} <= FEED["Subscribed"]:
+            quotes = live_quotes(exchange, snap["Tokens"])
+            SNAPSHOTS.append(key, quotes)
+            metric_inc("opbot_quote_snapshots_total", source="feed")
+            return quotes
+        fresh = time.time() - snap["Time"] < max_age
+        if fresh and snap["Tokens"] <= snap["Polled"]:
+            metric_inc("opbot_quote_snapshots_total", source="cache")
+            return snap["Quotes"]
+        last_err = None
+        want = set(snap["Tokens"])
+        for client in poll_clients(preferred):
+            try:
+                snap["Quotes"] = fetch_quotes(client, sorted(want), exchange)
+                snap["Polled"], snap["Time"] = want, time.time()
+                metric_inc("opbot_quote_snapshots_total", source="poll")
+                SNAPSHOTS.append(key, snap["Quotes"])
+                if STREAMING:
+                    seed_ticks(exchange, snap["Quotes"])
+                    subscribe_feed(exchange, want, preferred)
+                return snap["Quotes"]
+            except Exception as e: last_err = e
+        if last_err: raise last_err
+        return snap["Quotes"]
+
+@timed("opbot_quote_refresh")
+def fetch_data_for_user(cid, max_age=QUOTE_TTL):
     if cid not in USER_SESSIONS: return False, "❌ No Session"
-    if cid not in ACTIVE_TOKENS or not ACTIVE_TOKENS[cid]: 
+    if not ACTIVE_TOKENS.get(cid): 
         success, msg = auto_generate_chain(cid)
         if not success: return False, f"{msg}"
         
-    client = USER_SESSIONS[cid]
     idx_name = USER_SETTINGS[cid]["Index"]
-    conf = INDICES_CONFIG[idx_name]
     try:
-        all_tokens = ACTIVE_TOKENS[cid]
-        if not all_tokens: return False, "❌ Tokens list is empty"
+        chain = ACTIVE_TOKENS[cid]
+        if not chain: return False, "❌ Tokens list is empty"
             
-        live_map = {}
-        batch_size = 50
-        for i in range(0, len(all_tokens), batch_size):
-            batch = all_tokens[i : i + batch_size]
-            tokens = [{"instrument_token": x['Token'], "exchange_segment": conf["Exchange"]} for x in batch]
-            q = client.quotes(instrument_tokens=tokens, quote_type="all")
-            if q:
-                raw = q if isinstance(q, list) else q.get('data', [])
-                for item in raw:
-                    tk = str(item.get('exchange_token') or item.get('tk'))
-                    ltp_val = float(item.get('ltp', item.get('lastPrice', 0)))
-                    oi_val = int(item.get('open_int') or item.get('openInterest') or item.get('oi') or 0)
-                    live_map[tk] = {'ltp': ltp_val, 'oi': oi_val}
-        for item in all_tokens:
-            d = live_map.get(item['Token'], {'ltp': 0, 'oi': 0})
-            item['LTP'] = d['ltp']; item['OI'] = d['oi']
-        ACTIVE_TOKENS[cid] = all_tokens 
+        chain.update(get_market_snapshot(idx_name, chain.expiry, chain.token_list, cid, max_age))
         return True, "Success"
     except Exception as e: 
         return False, f"❌ Fetch Error: {str(e)}"
 
-def sl_monitor_thread():
-    while True:
+def order_book(client):
+    rep = client.order_report()
+    raw = rep.get('data', []) if isinstance(rep, dict) else (rep or [])
+    book = {}
+    for o in raw:
+        if not isinstance(o, dict): continue
+        try: price = float(o.get('avgPrc') or 0)
+        except (TypeError, ValueError): price = 0.0
+        book[str(o.get('nOrdNo'))] = {"Status": str(o.get('ordSt') or o.get('status') or '').upper(), "Price": price}
+    return book
+
+def order_params(exchange, symbol, qty, side):
+    return dict(exchange_segment=exchange, product="NRML", price="0", order_type="MKT", quantity=str(int(qty)), validity="DAY", trading_symbol=symbol, transaction_type=side, amo="NO")
+
+def place_market_order(client, exchange, symbol, qty, side):
+    return client.place_order(**order_params(exchange, symbol, qty, side))
+
+def leg_orders(cid):
+    # Confirm dialog ke time hi dono legs ke payload ready
+    t_data = PENDING_TRADE[cid]
+    exchange = INDICES_CONFIG[USER_SETTINGS[cid]["Index"]]["Exchange"]
+    return {"Hedge": order_params(exchange, t_data["Hedge"]["TradeSymbol"], t_data["Qty"], "B"),
+            "Main": order_params(exchange, t_data["Main"]["TradeSymbol"], t_data["Qty"], "S")}
+
+def await_order(cid, client, oid, timeout=HEDGE_WAIT):
+    # Order feed event ka wait; feed nahi hai to order book poll
+    with ORDER_LOCK:
+        done = ORDER_UPDATES.get(oid)
+        waiter = None if done else ORDER_WAITERS.setdefault(oid, threading.Event())
+    if done: return done
+    if ORDER_FEEDS.get(cid) is client and waiter.wait(timeout):
+        return ORDER_UPDATES.get(oid, {"Status": "", "Price": 0.0})
+    with ORDER_LOCK: ORDER_WAITERS.pop(oid, None)
+    return ORDER_UPDATES.get(oid) or wait_for_fills(client, [oid], timeout)[oid]
+
+def wait_for_fills(client, order_ids, timeout=FILL_TIMEOUT):
+    book, deadline = {}, time.time() + timeout
+    while order_ids:
+        try: book = order_book(client)
+        except Exception as e: print(f"Order Book Error: {e}")
+        if all(book.get(oid, {}).get("Status") in FINAL_STATUSES for oid in order_ids) or time.time() > deadline: break
+        time.sleep(0.3)
+    return {oid: book.get(oid, {"Status": "", "Price": 0.0}) for oid in order_ids}
+
+def cancel_orders(client, order_ids):
+    def _cancel(oid):
+        try: return client.cancel_order(order_id=oid)
+        except Exception as e: return e
+    return list(ORDER_POOL.map(_cancel, [oid for oid in order_ids if oid not in ("", "nan", "None")]))
+
+def run_exit_phase(client, rows, side):
+    futures = []
+    for row in rows:
+        conf = INDICES_CONFIG[row['Index']]
+        futures.append((row, ORDER_POOL.submit(place_market_order, client, conf["Exchange"], row['TradeSymbol'], row['Qty'], side)))
+    placed, failed = {}, []
+    for row, fut in futures:
         try:
-            # Fetch ONLY open trades with an active SL from MongoDB directly
-            open_sl_trades = list(trades_col.find({"Status": "OPEN", "SLOrderID": {"$nin": ["", "nan", None]}}))
+            resp = fut.result()
+            if isinstance(resp, dict) and 'nOrdNo' in resp: placed[str(resp['nOrdNo'])] = row
+            else: failed.append((row, resp))
+        except Exception as e: failed.append((row, e))
+    fills = wait_for_fills(client, list(placed.keys()))
+    return placed, fills, failed
+
+def execute_exit(client, rows):
+    # Sells pehle (margin safe), fills confirm hone ke baad hi Buys
+    updates, failed, pending = [], [], []
+    phases = [([r for r in rows if r['Side'] == 'SELL'], "B"), ([r for r in rows if r['Side'] == 'BUY'], "S")]
+    for phase_rows, side in phases:
+        if not phase_rows: continue
+        if pending or failed:
+            failed += [(r, "Held: previous phase not confirmed") for r in phase_rows]
+            continue
+        placed, fills, phase_failed = run_exit_phase(client, phase_rows, side)
+        failed += phase_failed
+        for oid, row in placed.items():
+            fill = fills[oid]
+            if fill["Status"] in ['COMPLETE', 'FILLED']:
+                updates.append((row["_id"], {"Status": "CLOSED", "ExitPrice": fill["Price"], "ExitOrderID": oid}))
+                if not fill["Price"]: add_pending_exit(int(row['ChatID']), oid, row)
+            elif fill["Status"] in ['REJECTED', 'CANCELLED']:
+                failed.append((row, fill["Status"]))
+            else:
+                # Fill confirm nahi hua, order live hai: LTP se close mark, agla phase hold
+                ltp = LIVE_TICKS.get((INDICES_CONFIG[row['Index']]["Exchange"], str(row['Token'])), {}).get('ltp', 0.0)
+                updates.append((row["_id"], {"Status": "CLOSED", "ExitPrice": ltp, "ExitOrderID": oid}))
+                add_pending_exit(int(row['ChatID']), oid, row)
+                pending.append(row)
+    return bulk_update_trades(updates), pending, failed
+
+def process_sl_status(row, status, price=None):
+    cid = int(row['ChatID'])
+    client = USER_SESSIONS.get(cid)
+    if not client: return
+    if status in ['COMPLETE', 'FILLED']:
+        claimed = claim_trade(row["_id"], {"Status": "CLOSED", "ExitPrice": price or row['SLPrice']})
+        if not claimed: return
+        # Actual SL fill price agle reconcile mein
+        if not price: add_pending_exit(cid, str(row['SLOrderID']), row)
+        bot.send_message(cid, f"🎯 **SL HIT:** {row['TradeSymbol']}\nClosing Hedge Automatically...")
+        
+        hedge_pos = find_open_trades(cid, "BUY", row['Index'])
+        if hedge_pos:
+            closed, pending, failed = execute_exit(client, hedge_pos)
+            if failed: bot.send_message(cid, "⚠️ Hedge close failed:\n" + "\n".join(f"{r['TradeSymbol']}: {err}" for r, err in failed))
             
-            for row in open_sl_trades:
-                sl_id = str(row.get('SLOrderID', ""))
-                cid = int(row['ChatID'])
-                if cid in USER_SESSIONS:
-                    client = USER_SESSIONS[cid]
-                    order_hist = client.order_history(order_id=sl_id)
-                    if order_hist and isinstance(order_hist, list):
-                        status = order_hist[0].get('status', '').upper()
-                        if status in ['COMPLETE', 'FILLED']:
-                            trades_col.update_one({"_id": row["_id"]}, {"$set": {"Status": "CLOSED", "ExitPrice": row['SLPrice']}})
-                            bot.send_message(cid, f"🎯 **SL HIT:** {row['TradeSymbol']}\nClosing Hedge Automatically...")
-                            
-                            hedge_pos = list(trades_col.find({"ChatID": str(cid), "Status": "OPEN", "Side": "BUY", "Index": row['Index']}))
-                            for h_row in hedge_pos:
-                                conf = INDICES_CONFIG[h_row['Index']]
-                                h_ltp = 0
-                                try:
-                                    hq = client.quotes(instrument_tokens=[{"instrument_token": str(h_row['Token']), "exchange_segment": conf["Exchange"]}], quote_type="all")
-                                    h_item = hq[0] if isinstance(hq, list) else hq.get('data', [{}])[0]
-                                    h_ltp = float(h_item.get('ltp', h_item.get('lastPrice', 0)))
-                                except: pass
-                                
-                                client.place_order(exchange_segment=conf["Exchange"], product="NRML", price="0", order_type="MKT", quantity=str(int(h_row['Qty'])), validity="DAY", trading_symbol=h_row['TradeSymbol'], transaction_type="S", amo="NO")
-                                trades_col.update_one({"_id": h_row["_id"]}, {"$set": {"Status": "CLOSED", "ExitPrice": h_ltp}})
-                                
-                        elif status in ['REJECTED', 'CANCELLED']:
-                            trades_col.update_one({"_id": row["_id"]}, {"$set": {"SLOrderID": "", "SLPrice": 0}})
-
-        except Exception as e: print(f"SL Monitor Error: {e}")
-        time.sleep(600)
-
-threading.Thread(target=sl_monitor_thread, daemon=True).start()
-
-def auto_updater():
+    elif status in ['REJECTED', 'CANCELLED']:
+        update_trade(row["_id"], {"SLOrderID": "", "SLPrice": 0}, {"SLOrderID": row['SLOrderID']})
+
+def trade_fills(client):
+    # Trade book se har order ka VWAP fill price (partial fills bhi)
+    rep = client.trade_report()
+    raw = rep.get('data', []) if isinstance(rep, dict) else (rep or [])
+    acc = {}
+    for t in raw:
+        if not isinstance(t, dict): continue
+        try: qty, prc = float(t.get('fldQty') or 0), float(t.get('avgPrc') or 0)
+        except (TypeError, ValueError): continue
+        a = acc.setdefault(str(t.get('nOrdNo')), [0.0, 0.0])
+        a[0] += qty; a[1] += qty * prc
+    return {oid: round(v / q, 2) for oid, (q, v) in acc.items() if q}
+
+def add_pending_exit(cid, oid, row):
+    PENDING_EXITS.setdefault(cid, {})[oid] = {"Row": row, "Date": datetime.now().strftime("%Y-%m-%d"), "Time": time.time()}
+
+def needs_reconcile(row):
+    # Purane din ke orders aaj ki order book mein nahi honge
+    unfilled = not row.get('Filled') and row.get('Date') == datetime.now().strftime("%Y-%m-%d")
+    return unfilled or row.get('SLOrderID') not in NO_SL
+
+def reconcile_session(cid, rows):
+    # Ek session = ek order book + ek trade book call, saare updates ek bulk write
+    client = USER_SESSIONS[cid]
+    book = order_book(client)
+    try: fills = trade_fills(client)
+    except Exception as e:
+        print(f"Trade Book Error: {e}")
+        fills = {}
+    price_of = lambda oid: fills.get(oid) or book.get(oid, {}).get("Price") or None
+    updates = []
+    for row in rows:
+        oid = str(row.get('OrderID'))
+        st = book.get(oid, {}).get("Status", "")
+        if not row.get('Filled'):
+            if st in ['COMPLETE', 'FILLED'] and price_of(oid):
+                updates.append((row["_id"], {"EntryPrice": price_of(oid), "Filled": True}))
+            elif st in ['REJECTED', 'CANCELLED']:
+                updates.append((row["_id"], {"Status": st, "ExitPrice": 0}))
+                continue
+        sl_id = str(row.get('SLOrderID', ""))
+        if sl_id not in NO_SL:
+            process_sl_status(row, book.get(sl_id, {}).get("Status", ""), price_of(sl_id))
+    for oid, pend in list(PENDING_EXITS.get(cid, {}).items()):
+        row, st = pend["Row"], book.get(oid, {}).get("Status", "")
+        if st in ['COMPLETE', 'FILLED'] and price_of(oid):
+            updates.append((row["_id"], {"ExitPrice": price_of(oid)}))
+            del PENDING_EXITS[cid][oid]
+        elif st in ['REJECTED', 'CANCELLED']:
+            # Exit order hi reject: position asal mein open hai, book mein wapas
+            reopen_trade(row)
+            del PENDING_EXITS[cid][oid]
+        elif pend["Date"] != datetime.now().strftime("%Y-%m-%d") or time.time() - pend["Time"] > PENDING_EXIT_TTL:
+            # Purane din ka (aaj ki book mein nahi) ya price kabhi nahi aaya: har 15s ke 2 broker calls band
+            metric_inc("opbot_pending_exits_dropped_total")
+            print(f"Pending Exit dropped ({cid}): {oid} {row['TradeSymbol']} status={st or 'not in book'}")
+            del PENDING_EXITS[cid][oid]
+            bot.send_message(cid, f"⚠️ Exit order {st}: {row['TradeSymbol']} is still OPEN.")
+    bulk_update_trades(updates)
+
+SL_STATE = {"LastPoll": 0}
+
+def sl_monitor_step():
+    try:
+        # Order feed events turant (jitne pending hain sab), phir SL_POLL_INTERVAL pe reconcile poll
+        try: events = [SL_EVENTS.get(timeout=max(0.1, min(WORKER_WAIT, SL_POLL_INTERVAL - (time.time() - SL_STATE["LastPoll"]))))]
+        except queue.Empty: events = []
+        while not SL_EVENTS.empty(): events.append(SL_EVENTS.get_nowait())
+        for _, sl_id, status, price in events:
+            try:
+                # Feed ka avgPrc mila to wahi exit price (warna SLPrice + reconcile)
+                row = find_trade(sl_order_id=sl_id, open_only=True)
+                if row: process_sl_status(row, status, price or None)
+            except Exception as e: print(f"SL Event Error ({sl_id}): {e}")
+        # Events ki stream poll ko kabhi na roke
+        if time.time() - SL_STATE["LastPoll"] < SL_POLL_INTERVAL: return
+        
+        SL_STATE["LastPoll"] = time.time()
+        by_cid = {}
+        for row in find_open_trades():
+            if needs_reconcile(row): by_cid.setdefault(int(row['ChatID']), []).append(row)
+        for cid, pending in list(PENDING_EXITS.items()):
+            if pending: by_cid.setdefault(cid, [])
+        
+        for cid, rows in by_cid.items():
+            if not has_session(cid): continue
+            start_order_feed(cid)
+            try: reconcile_session(cid, rows)
+            except Exception as e:
+                metric_inc("opbot_errors_total", where="reconcile")
+                print(f"Reconcile Error ({cid}): {e}")
+
+    except Exception as e: print(f"SL Monitor Error: {e}")
+
+def sl_monitor_thread():
+    while True: sl_monitor_step()
+
+def market_open(now=None):
+    now = now or datetime.now(IST)
+    if now.weekday() >= 5 or now.strftime("%Y-%m-%d") in MARKET_HOLIDAYS: return False
+    return MARKET_HOURS[0] <= (now.hour, now.minute) < MARKET_HOURS[1]
+
+def refresh_interval(cid):
+    # Chain: recent activity = normal, baaki idle (positions ke tokens apni alag key pe REFRESH_FAST)
+    if time.time() - LAST_ACTIVE.get(cid, 0) < ACTIVE_WINDOW: return REFRESH_ACTIVE
+    return REFRESH_IDLE
+
+def refresh_cost(key, tokens, max_age=QUOTE_TTL):
+    # Feed se mil raha hai / snapshot abhi fresh hai to broker call nahi
+    exchange = INDICES_CONFIG[key[0]]["Exchange"]
+    if feed_alive() and {(exchange, tk) for tk in tokens} <= FEED["Subscribed"]: return 0
+    snap = MARKET_DATA.get(key)
+    if snap and time.time() - snap["Time"] < max_age and tokens <= snap["Polled"]: return 0
+    return -(-len(tokens) // QUOTE_BATCH)
+
+def position_key(idx_name):
+    # Open positions/SL ke tokens: (index, "") key, sirf yahi REFRESH_FAST pe (poori chain nahi)
+    return (idx_name, "")
+
+def refresh_keys():
+    # Key = (index, expiry) chain ke liye, position_key(index) positions ke liye
+    keys = {}
+    def add(key, cid, interval, tokens):
+        k = keys.setdefault(key, {"Interval": REFRESH_IDLE, "Users": [], "Tokens": set()})
+        k["Interval"] = min(k["Interval"], interval)
+        if cid not in k["Users"]: k["Users"].append(cid)
+        k["Tokens"] |= tokens
+    for cid in list(USER_SESSIONS.keys()):
+        chain = ACTIVE_TOKENS.get(cid)
+        if chain: add((USER_SETTINGS[cid]["Index"], chain.expiry), cid, refresh_interval(cid), set(chain.token_list))
+        for r in open_rows(cid): add(position_key(r['Index']), cid, REFRESH_FAST, {str(r['Token'])})
+    return keys
+
+def prune_tokens(keys):
+    # Union sirf badhta tha: ab har cycle current chains (+ open positions) se dobara, baaki poll/feed se bahar
+    for key in list(MARKET_DATA):
+        want = keys[key]["Tokens"] if key in keys else set()
+        with MARKET_LOCKS[key]:
+            snap = MARKET_DATA[key]
+            if not want:
+                del MARKET_DATA[key]
+                continue
+            snap["Tokens"] &= want
+            snap["Polled"] = snap["Polled"] & want
+            snap["Quotes"] = {tk: q for tk, q in snap["Quotes"].items() if tk in want}
+    wanted = {(INDICES_CONFIG[key[0]]["Exchange"], tk) for key, k in keys.items() for tk in k["Tokens"]}
+    wanted |= {(INDICES_CONFIG[r['Index']]["Exchange"], str(r['Token'])) for r in open_rows()} | set(PNL_WATCH)
+    with FEED_LOCK:
+        stale = FEED["Subscribed"] - wanted
+        if not stale: return
+        client = FEED["Client"]
+        try:
+            if client is not None and FEED["Open"] and hasattr(client, "un_subscribe"):
+                client.un_subscribe(instrument_tokens=[{"instrument_token": tk, "exchange_segment": ex} for ex, tk in stale], isIndex=False, isDepth=False)
+        except Exception as e: print(f"Feed Unsubscribe Error: {e}")
+        FEED["Subscribed"] = FEED["Subscribed"] - stale
+        for t in stale: LIVE_TICKS.pop(t, None)
+    metric_inc("opbot_tokens_pruned_total", len(stale))
+
+def refresh_scheduler_step():
+    # Returns: agli baar kitne second baad jagna hai
+    keys = refresh_keys()
+    prune_tokens(keys)
+    if not market_open():
+        REFRESH_DUE.clear()
+        return REFRESH_ACTIVE
+    for key in list(REFRESH_DUE):
+        if key not in keys: del REFRESH_DUE[key]
+    now = time.time()
+    # Due keys: fast cadence pehle, phir sabse purana
+    for key, k in sorted(keys.items(), key=lambda kv: (kv[1]["Interval"], REFRESH_DUE.get(kv[0], 0))):
+        if REFRESH_DUE.get(key, 0) > now: continue
+        register_tokens(key, k["Tokens"])
+        # Budget sirf scheduler ke apne quote polls ka (orders/reconcile/user fetch isse nahi katte)
+        cost = refresh_cost(key, k["Tokens"], k["Interval"])
+        if cost and not BROKER_BUDGET.try_acquire(cost):
+            metric_inc("opbot_refresh_skipped_total", reason="budget")
+            continue
+        try:
+            # Ek poll per key, saare users ki chain usi shared snapshot se
+            with timed("opbot_quote_refresh"):
+                quotes = get_market_snapshot(key[0], key[1], k["Tokens"], k["Users"][0], k["Interval"])
+            for cid in k["Users"]:
+                chain = ACTIVE_TOKENS.get(cid)
+                if chain and (USER_SETTINGS[cid]["Index"], chain.expiry) == key: chain.update(quotes)
+            REFRESH_DUE[key] = now + k["Interval"]
+            metric_inc("opbot_refresh_total", interval=k["Interval"])
+        except Exception as e: print(f"Refresh Error {key}: {e}")
+    due = [t - now for t in REFRESH_DUE.values()]
+    return min(max(1, min(due)), REFRESH_FAST) if due else REFRESH_FAST
+
+def refresh_scheduler():
     while True:
+        try: wait = refresh_scheduler_step()
+        except Exception as e:
+            print(f"Scheduler Error: {e}")
+            wait = REFRESH_FAST
+        time.sleep(wait)
+
+def position_ltps(cid, rows):
+    client = USER_SESSIONS[cid]
+    token_list = []
+    ltp_map = {}
+    for r in rows:
+        conf = INDICES_CONFIG[r['Index']]
+        # Scheduler ka position snapshot (REFRESH_FAST pe poll hota hai; ek cycle late bhi chalega)
+        snap = MARKET_DATA.get(position_key(r['Index']))
+        if feed_alive() and (conf["Exchange"], str(r['Token'])) in FEED["Subscribed"]:
+            ltp_map[str(r['Token'])] = LIVE_TICKS.get((conf["Exchange"], str(r['Token'])), {}).get('ltp', 0.0)
+        elif snap and time.time() - snap["Time"] < 2 * REFRESH_FAST and str(r['Token']) in snap["Quotes"]:
+            ltp_map[str(r['Token'])] = snap["Quotes"][str(r['Token'])]['ltp']
+        else:
+            token_list.append({"instrument_token": str(r['Token']), "exchange_segment": conf["Exchange"]})
+    
+    if token_list:
+        q = client.quotes(instrument_tokens=token_list, quote_type="all")
+        raw = q if isinstance(q, list) else q.get('data', [])
+        for item in raw:
+            tk = str(item.get('exchange_token') or item.get('tk'))
+            ltp_val = float(item.get('ltp', item.get('lastPrice', 0)))
+            ltp_map[tk] = ltp_val
+        # Agli baar positions ka LTP live feed se milega
+        polled = {t["instrument_token"] for t in token_list}
+        subscribe_positions(cid, [r for r in rows if str(r['Token']) in polled])
+    return ltp_map
+
+def subscribe_positions(cid, rows):
+    # Exchange wise ek hi subscribe call (har position ka alag nahi)
+    by_exchange = {}
+    for r in rows: by_exchange.setdefault(INDICES_CONFIG[r['Index']]["Exchange"], set()).add(str(r['Token']))
+    for exchange, tokens in by_exchange.items(): subscribe_feed(exchange, tokens, cid)
+
+def position_pnl(r, ltp):
+    qty = int(r['Qty'])
+    entry = float(r['EntryPrice'])
+    if r['Side'] == 'SELL': return (entry - ltp) * qty
+    return (ltp - entry) * qty
+
+def pnl_line(r, ltp, pnl):
+    icon = "🟢" if pnl >= 0 else "🔴"
+    return f"{icon} **{r['TradeSymbol']}**\nEntry: {float(r['EntryPrice'])} | LTP: {ltp}\nPnL: **{pnl:+.2f}**\n\n"
+
+def render_pnl(rows, ltp_map, title="💰 **Live P&L Report**"):
+    msg = f"{title}\n\n"
+    total_pnl = 0.0
+    for r in rows:
+        ltp = ltp_map.get(str(r['Token']), 0.0)
+        pnl = position_pnl(r, ltp)
+        total_pnl += pnl
+        msg += pnl_line(r, ltp, pnl)
+    msg += f"────────────────\n**Total P&L: {total_pnl:+.2f}**"
+    return msg
+
+def pnl_view_text(view):
+    body = "".join(view["Lines"][_id] for _id in view["Rows"])
+    total = sum(view["PnL"].values())
+    return (f"📡 **Live P&L** ({datetime.now().strftime('%H:%M:%S')})\n\n{body}"
+            f"────────────────\n**Total P&L: {total:+.2f}**")
+
+def build_pnl_view(cid, rows, ltp_map):
+    view = {"Rows": {}, "LTP": {}, "PnL": {}, "Lines": {}, "ByKey": {}, "Dirty": True}
+    for r in rows:
+        key = (INDICES_CONFIG[r['Index']]["Exchange"], str(r['Token']))
+        ltp = ltp_map.get(str(r['Token']), 0.0)
+        view["Rows"][r["_id"]] = r
+        view["LTP"][r["_id"]], view["PnL"][r["_id"]] = ltp, position_pnl(r, ltp)
+        view["Lines"][r["_id"]] = pnl_line(r, ltp, view["PnL"][r["_id"]])
+        view["ByKey"].setdefault(key, []).append(r["_id"])
+    return view
+
+def watch_pnl(cid, view):
+    # Lock ke andar call karein
+    for key in list(PNL_WATCH):
+        PNL_WATCH[key].discard(cid)
+        if not PNL_WATCH[key]: del PNL_WATCH[key]
+    if view:
+        for key in view["ByKey"]: PNL_WATCH.setdefault(key, set()).add(cid)
+
+def on_pnl_tick(key, ltp):
+    # Sirf us position ka P&L dobara, aur sirf jab LTP badla ho
+    with PNL_LOCK:
+        for cid in PNL_WATCH.get(key, ()):
+            view = LIVE_PNL.get(cid)
+            if not view: continue
+            for _id in view["ByKey"].get(key, ()):
+                if view["LTP"][_id] == ltp: continue
+                r = view["Rows"][_id]
+                view["LTP"][_id], view["PnL"][_id] = ltp, position_pnl(r, ltp)
+                view["Lines"][_id] = pnl_line(r, ltp, view["PnL"][_id])
+                view["Dirty"] = True
+
+def start_live_pnl(cid):
+    rows = find_open_trades(cid)
+    if not rows: return False
+    ltp_map = position_ltps(cid, rows)
+    subscribe_positions(cid, rows)
+    view = build_pnl_view(cid, rows, ltp_map)
+    view["Text"] = pnl_view_text(view)
+    mk = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("⏹️ Stop Live P&L", callback_data="PNL_STOP"))
+    msg = bot.send_message(cid, view["Text"], reply_markup=mk)
+    view.update({"MsgID": msg.message_id, "Until": time.time() + PNL_LIVE_TTL, "Dirty": False, "Markup": mk})
+    try: bot.pin_chat_message(cid, msg.message_id, disable_notification=True)
+    except Exception as e: print(f"Pin Error: {e}")
+    stop_live_pnl(cid)
+    with PNL_LOCK:
+        LIVE_PNL[cid] = view
+        watch_pnl(cid, view)
+    return True
+
+def stop_live_pnl(cid, final_text=None):
+    with PNL_LOCK:
+        view = LIVE_PNL.pop(cid, None)
+        watch_pnl(cid, None)
+    if not view: return
+    try: bot.unpin_chat_message(cid, view["MsgID"])
+    except Exception: pass
+    if final_text:
+        try: bot.edit_message_text(final_text, cid, view["MsgID"])
+        except Exception: pass
+
+def pnl_refresher_step():
+    for cid, view in list(LIVE_PNL.items()):
         try:
-            for cid in list(USER_SESSIONS.keys()): fetch_data_for_user(cid)
-        except: pass
-        time.sleep(180) 
-threading.Thread(target=auto_updater, daemon=True).start()
+            if time.time() > view["Until"] or cid not in USER_SESSIONS:
+                stop_live_pnl(cid, view["Text"] + "\n\n⏹️ Live P&L stopped.")
+                continue
+            rows = find_open_trades(cid)
+            if not rows:
+                # Book khali: polling/edit band, chat LIVE_PNL se bahar
+                stop_live_pnl(cid, view["Text"] + "\n\n✅ No open positions. Live P&L stopped.")
+                continue
+            if set(r["_id"] for r in rows) != set(view["Rows"]):
+                # Position khuli/band hui: view dobara banao
+                fresh = build_pnl_view(cid, rows, {str(r['Token']): LIVE_TICKS.get((INDICES_CONFIG[r['Index']]["Exchange"], str(r['Token'])), {}).get('ltp', 0.0) for r in rows})
+                fresh.update({k: view[k] for k in ("MsgID", "Until", "Text", "Markup") if k in view})
+                with PNL_LOCK:
+                    LIVE_PNL[cid] = view = fresh
+                    watch_pnl(cid, view)
+            if not feed_alive() and time.time() - view.get("Polled", 0) > SL_POLL_INTERVAL:
+                # Feed band hai to dheere polling fallback
+                view["Polled"] = time.time()
+                ltps = position_ltps(cid, rows)
+                for r in rows: on_pnl_tick((INDICES_CONFIG[r['Index']]["Exchange"], str(r['Token'])), ltps.get(str(r['Token']), 0.0))
+            if not view["Dirty"]: continue
+            with PNL_LOCK:
+                view["Dirty"] = False
+                text = pnl_view_text(view)
+            if text.split("\n", 1)[1] == view["Text"].split("\n", 1)[1]: continue
+            view["Text"] = text
+            bot.edit_message_text(text, cid, view["MsgID"], reply_markup=view["Markup"])
+        except Exception as e: print(f"Live P&L Error ({cid}): {e}")
+
+def pnl_refresher():
+    while True:
+        time.sleep(PNL_EDIT_INTERVAL)
+        pnl_refresher_step()
+
+def start_workers():
+    threading.Thread(target=trade_writer, daemon=True).start()
+    threading.Thread(target=sl_monitor_thread, daemon=True).start()
+    threading.Thread(target=refresh_scheduler, daemon=True).start()
+    threading.Thread(target=pnl_refresher, daemon=True).start()
+    threading.Thread(target=session_keeper, daemon=True).start()
+    threading.Thread(target=master_ingester, daemon=True).start()
 # =========================================
 # --- 3. MENUS ---
 # =========================================
@@ -280,13 +1779,42 @@ def get_main_menu(cid):
 def get_login_btn():
     return types.ReplyKeyboardMarkup(resize_keyboard=True).add(types.KeyboardButton("🔐 Login Now"))
 
+def trade_confirm(cid, mode="RATIO", value=HEDGE_RATIO):
+    t_data = PENDING_TRADE[cid]
+    idx = USER_SETTINGS[cid]["Index"]
+    conf = INDICES_CONFIG[idx]
+    main, hedges = pick_trade(ACTIVE_TOKENS[cid], t_data["Type"], t_data["Target"], mode, value)
+    if not main: return "❌ No Data.", None
+    if not hedges: return "❌ Hedge not found.", None
+    hedge = hedges[0]
+    t_data["Main"], t_data["Hedge"] = main, hedge
+    t_data["Orders"] = leg_orders(cid)
+    start_order_feed(cid)
+    lots = t_data["Qty"] // conf["LotSize"]
+    alts = ", ".join(f"{h['Strike']}@{h['LTP']}" for h in hedges[1:4])
+    msg = (f"⚡ **CONFIRM {idx} TRADE**\nLots: {lots} (Qty: {t_data['Qty']})\n"
+           f"🔴 SELL: {main['TradeSymbol']} (@{main['LTP']})\n"
+           f"🟢 BUY: {hedge['TradeSymbol']} (@{hedge['LTP']})\n"
+           f"Hedge by {HEDGE_MODES[mode]}" + (f" | Alt: {alts}" if alts else "") + "\nExecute?")
+    gap = conf["StrikeGap"]
+    mk = types.InlineKeyboardMarkup(row_width=3)
+    mk.add(types.InlineKeyboardButton("10%", callback_data="HEDGE_RATIO_0.1"),
+           types.InlineKeyboardButton("20%", callback_data="HEDGE_RATIO_0.2"),
+           types.InlineKeyboardButton("30%", callback_data="HEDGE_RATIO_0.3"),
+           types.InlineKeyboardButton(f"+{gap * 5} pts", callback_data=f"HEDGE_DIST_{gap * 5}"),
+           types.InlineKeyboardButton(f"+{gap * 10} pts", callback_data=f"HEDGE_DIST_{gap * 10}"),
+           types.InlineKeyboardButton("Δ 0.10", callback_data="HEDGE_DELTA_0.1"))
+    mk.add(types.InlineKeyboardButton("🔥 FIRE", callback_data="EXECUTE_TRADE"),
+           types.InlineKeyboardButton("❌ CANCEL", callback_data="CANCEL_TRADE"))
+    return msg, mk
+
 # =========================================
 # --- 4. COMMAND HANDLERS ---
 # =========================================
 @bot.message_handler(commands=['logout'])
 def cmd_logout(message):
     cid = message.chat.id
-    if cid in USER_SESSIONS: del USER_SESSIONS[cid]
+    drop_session(cid)
     bot.send_message(cid, "👋 You are Logged Out.", reply_markup=get_login_btn())
 
 @bot.message_handler(commands=['login'])
@@ -298,12 +1826,74 @@ def cmd_login_command(message):
     else:
         bot.send_message(cid, "❌ User not found. Type /start to register.")
 
+@bot.message_handler(commands=['refresh_master'])
+def cmd_refresh_master(message):
+    cid = message.chat.id
+    # Poora fo_master scan: sirf admin (baaki users ko daily cache kaafi hai)
+    if cid not in ADMIN_CHAT_IDS: return bot.send_message(cid, "⛔ Admin only.")
+    if not has_session(cid): return
+    bot.send_message(cid, "⏳ Reloading F&O Master...")
+    try:
+        refresh_master()
+        ACTIVE_TOKENS[cid] = []
+        success, msg = auto_generate_chain(cid)
+        bot.send_message(cid, f"✅ Master Reloaded. {msg}" if success else f"{msg}")
+    except Exception as e: bot.send_message(cid, f"❌ Master Reload Error: {e}")
+
+@bot.message_handler(commands=['ingest_master'])
+def cmd_ingest_master(message):
+    cid = message.chat.id
+    if cid not in ADMIN_CHAT_IDS: return bot.send_message(cid, "⛔ Admin only.")
+    if not has_session(cid): return
+    bot.send_message(cid, "⏳ Downloading scrip master...")
+    try:
+        ok, stats = ingest_master(USER_SESSIONS[cid])
+        if not ok: return bot.send_message(cid, stats)
+        bot.send_message(cid, f"✅ Master updated.\nRows read: {stats['Rows']} | Kept: {stats['Kept']}\nChanged: {stats['Upserts']} | Removed: {stats['Deleted']} | Chains reset: {stats['Chains']}")
+    except Exception as e: bot.send_message(cid, f"❌ Master Ingest Error: {e}")
+
+@bot.message_handler(commands=['expiry'])
+def cmd_expiry(message):
+    cid = message.chat.id
+    if not has_session(cid): return
+    mk = types.InlineKeyboardMarkup(row_width=3)
+    mk.add(types.InlineKeyboardButton("📅 Current", callback_data="EXP_NEAR"),
+           types.InlineKeyboardButton("⏭️ Next Week", callback_data="EXP_NEXT"),
+           types.InlineKeyboardButton("🗓️ Monthly", callback_data="EXP_MONTHLY"))
+    bot.send_message(cid, f"Select Expiry (Now: {USER_SETTINGS[cid].get('Expiry') or '-'}):", reply_markup=mk)
+
+@bot.message_handler(commands=['buildup'])
+def cmd_buildup(message):
+    cid = message.chat.id
+    if not has_session(cid): return
+    try:
+        parts = message.text.split()
+        mins = int(parts[1]) if len(parts) > 1 else 30
+        chain = ACTIVE_TOKENS.get(cid)
+        if not chain:
+            bot.send_message(cid, "❌ Chain not ready. Refresh Data first.")
+            return
+        since, chg = SNAPSHOTS.change_since((USER_SETTINGS[cid]["Index"], chain.expiry), time.time() - mins * 60)
+        rows = [(tk, d) for tk, d in chg.items() if tk in chain.index]
+        if not rows:
+            bot.send_message(cid, "❌ No snapshots yet for this chain.")
+            return
+        msg = f"📈 **OI Buildup since {datetime.fromtimestamp(since, IST).strftime('%H:%M')}**\n"
+        for opt_type, mask in (("CE", chain.is_ce), ("PE", chain.is_pe)):
+            side = sorted((r for r in rows if mask[chain.index[r[0]]]), key=lambda r: -r[1]["oi"])[:5]
+            msg += f"\n{opt_type}:\n"
+            for tk, d in side:
+                i = chain.index[tk]
+                msg += f"{chain.strikes[i]:g} | OI {format_crore_lakh(d['oi'])} | Prem {d['ltp']:+.2f}\n"
+        bot.send_message(cid, msg)
+    except Exception as e: bot.send_message(cid, f"❌ Buildup Error: {e}")
+
 @bot.message_handler(commands=['start'])
 def cmd_start(message):
     cid = message.chat.id
     load_users()
     if cid in USER_DETAILS:
-        if cid in USER_SESSIONS:
+        if has_session(cid):
             bot.send_message(cid, f"👋 Ready! Index: **{USER_SETTINGS[cid]['Index']}**", reply_markup=get_main_menu(cid))
         else:
             bot.send_message(cid, f"👋 Welcome back **{USER_DETAILS[cid].get('Name', '')}**!", reply_markup=get_login_btn())
@@ -365,20 +1955,23 @@ def main_handler(message):
                 return
 
             cl = NeoAPI(consumer_key=api_key, environment='prod')
-            cl.totp_login(mobile_number=u.get('Mobile'), ucc=u.get('UCC'), totp=text)
-            cl.totp_validate(mpin=u.get('MPIN'))
+            # Login calls instrument_client se pehle hote hain: yahan alag se time
+            with timed("opbot_broker", call="totp_login"): cl.totp_login(mobile_number=u.get('Mobile'), ucc=u.get('UCC'), totp=text)
+            with timed("opbot_broker", call="totp_validate"): cl.totp_validate(mpin=u.get('MPIN'))
             
-            USER_SESSIONS[cid] = cl
+            USER_SESSIONS[cid] = instrument_client(cl)
+            save_session(cid, cl)
             USER_STATE[cid] = None
             idx = USER_SETTINGS[cid]["Index"]
             bot.send_message(cid, f"✅ Logged In! Index: {idx}", reply_markup=get_main_menu(cid))
+            start_order_feed(cid)
             auto_generate_chain(cid)
         except Exception as e:
             bot.send_message(cid, f"❌ Login Failed: {e}", reply_markup=get_login_btn())
             USER_STATE[cid] = None
         return
 
-    if cid not in USER_SESSIONS: return
+    if not has_session(cid): return
 
     if "Index:" in text:
         mk = types.InlineKeyboardMarkup()
@@ -388,7 +1981,7 @@ def main_handler(message):
 
     elif text == "🔄 Refresh Data":
         bot.send_message(cid, "⏳ Updating Data...")
-        success, msg = fetch_data_for_user(cid)
+        success, msg = fetch_data_for_user(cid, max_age=5)
         if success: bot.send_message(cid, "✅ Data Updated")
         else: bot.send_message(cid, f"{msg}")
 
@@ -399,43 +1992,14 @@ def main_handler(message):
 
     elif text == "💰 P&L":
         try:
-            my_open = list(trades_col.find({"ChatID": str(cid), "Status": "OPEN"}))
+            my_open = find_open_trades(cid)
             if not my_open:
                 bot.send_message(cid, "✅ No Open Trades.")
                 return
 
-            client = USER_SESSIONS[cid]
-            token_list = []
-            for r in my_open:
-                conf = INDICES_CONFIG[r['Index']]
-                token_list.append({"instrument_token": str(r['Token']), "exchange_segment": conf["Exchange"]})
-            
-            ltp_map = {}
-            if token_list:
-                q = client.quotes(instrument_tokens=token_list, quote_type="all")
-                raw = q if isinstance(q, list) else q.get('data', [])
-                for item in raw:
-                    tk = str(item.get('exchange_token') or item.get('tk'))
-                    ltp_val = float(item.get('ltp', item.get('lastPrice', 0)))
-                    ltp_map[tk] = ltp_val
-
-            msg = "💰 **Live P&L Report**\n\n"
-            total_pnl = 0.0
-            
-            for r in my_open:
-                ltp = ltp_map.get(str(r['Token']), 0.0)
-                qty = int(r['Qty'])
-                entry = float(r['EntryPrice'])
-                
-                if r['Side'] == 'SELL': pnl = (entry - ltp) * qty
-                else: pnl = (ltp - entry) * qty
-                
-                total_pnl += pnl
-                icon = "🟢" if pnl >= 0 else "🔴"
-                msg += f"{icon} **{r['TradeSymbol']}**\nEntry: {entry} | LTP: {ltp}\nPnL: **{pnl:+.2f}**\n\n"
-            
-            msg += f"────────────────\n**Total P&L: {total_pnl:+.2f}**"
-            bot.send_message(cid, msg)
+            ltp_map = position_ltps(cid, my_open)
+            mk = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("📡 Live P&L", callback_data="PNL_LIVE"))
+            bot.send_message(cid, render_pnl(my_open, ltp_map), reply_markup=mk)
         except Exception as e: bot.send_message(cid, f"P&L Error: {e}")
 
     elif text == "📊 OI Data":
@@ -487,31 +2051,9 @@ def main_handler(message):
             qty = int(lots * conf["LotSize"])
             PENDING_TRADE[cid]["Qty"] = qty
             fetch_data_for_user(cid)
-            df = pd.DataFrame(ACTIVE_TOKENS[cid])
-            target = PENDING_TRADE[cid]["Target"]
-            opt_type = PENDING_TRADE[cid]["Type"]
-            df = df[(df['Type'] == opt_type) & (df['LTP'] > 0)]
-            if df.empty:
-                bot.send_message(cid, "❌ No Data.")
-                return
-            main = df[df['LTP'] <= target].sort_values('LTP', ascending=False)
-            main = main.iloc[0] if not main.empty else df.sort_values('LTP', ascending=True).iloc[0]
-            if opt_type == 'CE': pool = df[df['Strike'] > main['Strike']].copy()
-            else: pool = df[df['Strike'] < main['Strike']].copy()
-            if pool.empty:
-                bot.send_message(cid, "❌ Hedge not found.")
-                return
-            pool['diff'] = abs(pool['LTP'] - (main['LTP'] * 0.20))
-            hedge = pool.sort_values(by=['diff', 'LTP']).iloc[0]
-            PENDING_TRADE[cid]["Main"] = main.to_dict()
-            PENDING_TRADE[cid]["Hedge"] = hedge.to_dict()
-            msg = (f"⚡ **CONFIRM {idx} TRADE**\nLots: {lots} (Qty: {qty})\n"
-                   f"🔴 SELL: {main['TradeSymbol']} (@{main['LTP']})\n"
-                   f"🟢 BUY: {hedge['TradeSymbol']} (@{hedge['LTP']})\nExecute?")
-            mk = types.InlineKeyboardMarkup()
-            mk.add(types.InlineKeyboardButton("🔥 FIRE", callback_data="EXECUTE_TRADE"),
-                   types.InlineKeyboardButton("❌ CANCEL", callback_data="CANCEL_TRADE"))
+            msg, mk = trade_confirm(cid)
             bot.send_message(cid, msg, reply_markup=mk)
+            if not mk: return
             USER_STATE[cid] = None
         except Exception as e: bot.send_message(cid, f"❌ Error: {e}")
 
@@ -519,21 +2061,19 @@ def main_handler(message):
         try:
             n = int(text)
             fetch_data_for_user(cid)
-            df = pd.DataFrame(ACTIVE_TOKENS[cid])
-            if 'OI' not in df.columns: df['OI'] = 0
-            df['OI'] = df['OI'].fillna(0).astype(int)
-            ce_df = df[df['Type'] == 'CE'].sort_values('Strike').reset_index(drop=True)
-            pe_df = df[df['Type'] == 'PE'].sort_values('Strike').reset_index(drop=True)
-            mid = len(ce_df) // 2 
-            sel_pe = pe_df.iloc[max(0, mid-n) : mid+1] 
-            sel_ce = ce_df.iloc[mid : min(len(ce_df), mid+n+1)]
-            pe_oi = sel_pe['OI'].sum()
-            ce_oi = sel_ce['OI'].sum()
-            diff = pe_oi - ce_oi
-            msg = (f"📊 **OI Analysis (ATM ±{n})**\n"
+            chain = ACTIVE_TOKENS[cid]
+            r = chain.oi_range(n)
+            pe_oi, ce_oi, diff = r["PE"], r["CE"], r["Diff"]
+            msg = (f"📊 **OI Analysis (ATM {chain.ladder[chain.atm_i]:g} ±{n})**\n"
                    f"🛡️ PE (Supp): {format_crore_lakh(pe_oi)}\n"
                    f"⚔️ CE (Res): {format_crore_lakh(ce_oi)}\n"
-                   f"Diff: **{format_crore_lakh(diff)}**")
+                   f"Diff: **{format_crore_lakh(diff)}**\n\n"
+                   f"±N | PE | CE | PCR | ΔPE | ΔCE\n")
+            for k in sorted(set(OI_RANGES + [n])):
+                r = chain.oi_range(k)
+                msg += f"±{k} | {format_crore_lakh(r['PE'])} | {format_crore_lakh(r['CE'])} | {r['PCR']:.2f} | {format_crore_lakh(r['PEChg'])} | {format_crore_lakh(r['CEChg'])}\n"
+            msg += f"\nPCR (Chain): {chain.pcr():.2f}"
+            if chain.max_pain is not None: msg += f" | Max Pain: {chain.max_pain:g}"
             bot.send_message(cid, msg, reply_markup=get_main_menu(cid))
             USER_STATE[cid] = None
         except Exception as e: bot.send_message(cid, f"❌ OI Error: {e}")
@@ -543,7 +2083,7 @@ def main_handler(message):
 @bot.callback_query_handler(func=lambda call: True)
 def on_callback(call):
     cid = call.message.chat.id
-    if cid not in USER_SESSIONS: return
+    if not has_session(cid): return
     
     # --- INDEX SELECTION ---
     if call.data == "SET_NIFTY":
@@ -558,30 +2098,48 @@ def on_callback(call):
         bot.send_message(cid, "✅ Index: SENSEX", reply_markup=get_main_menu(cid))
         auto_generate_chain(cid)
 
+    elif call.data.startswith("EXP_"):
+        USER_SETTINGS[cid]["ExpiryMode"] = call.data.split("_")[1]
+        ACTIVE_TOKENS[cid] = []
+        success, msg = auto_generate_chain(cid)
+        bot.send_message(cid, f"✅ {msg}" if success else f"{msg}")
+
     # --- TRADE FLOW ---
     elif call.data in ["TRADE_CE", "TRADE_PE"]:
         PENDING_TRADE[cid] = {"Type": "CE" if "CE" in call.data else "PE"}
         USER_STATE[cid] = "WAIT_PREMIUM"
         bot.send_message(cid, "💰 Enter Sell Premium Target:")
 
+    elif call.data.startswith("HEDGE_"):
+        try:
+            _, mode, value = call.data.split("_")
+            msg, mk = trade_confirm(cid, mode, float(value))
+            bot.edit_message_text(msg, cid, call.message.message_id, reply_markup=mk)
+        except Exception as e: bot.send_message(cid, f"❌ Error: {e}")
+
     elif call.data == "EXECUTE_TRADE":
         try:
-            bot.edit_message_text("⏳ Executing Market Orders...", cid, call.message.message_id)
+            # Status edit parallel mein, orders critical path pe
+            ORDER_POOL.submit(bot.edit_message_text, "⏳ Executing Market Orders...", cid, call.message.message_id)
             t_data = PENDING_TRADE[cid]
             idx = USER_SETTINGS[cid]["Index"]
-            conf = INDICES_CONFIG[idx]
             client = USER_SESSIONS[cid]
             qty = int(t_data["Qty"])
+            orders = t_data.get("Orders") or leg_orders(cid)
             
-            resp_hedge = client.place_order(exchange_segment=conf["Exchange"], product="NRML", price="0", order_type="MKT", quantity=str(qty), validity="DAY", trading_symbol=t_data["Hedge"]["TradeSymbol"], transaction_type="B", amo="NO")
+            resp_hedge = client.place_order(**orders["Hedge"])
             if not isinstance(resp_hedge, dict) or 'nOrdNo' not in resp_hedge:
                 bot.send_message(cid, f"❌ Hedge Buy Failed: {resp_hedge}")
                 return
 
-            time.sleep(0.2)
-            resp_main = client.place_order(exchange_segment=conf["Exchange"], product="NRML", price="0", order_type="MKT", quantity=str(qty), validity="DAY", trading_symbol=t_data["Main"]["TradeSymbol"], transaction_type="S", amo="NO")
+            # Fixed sleep ki jagah hedge ka order update; reject hua to main SELL nahi
+            hedge_fill = await_order(cid, client, str(resp_hedge['nOrdNo']))
+            if hedge_fill["Status"] in ['REJECTED', 'CANCELLED']:
+                bot.send_message(cid, f"❌ Hedge Buy {hedge_fill['Status']}: Main SELL not placed.")
+                return
+            resp_main = client.place_order(**orders["Main"])
             
-            log_trade(cid, idx, t_data["Hedge"]["TradeSymbol"], t_data["Hedge"]["Token"], t_data["Type"], "BUY", qty, t_data["Hedge"]["LTP"], str(resp_hedge['nOrdNo']))
+            log_trade(cid, idx, t_data["Hedge"]["TradeSymbol"], t_data["Hedge"]["Token"], t_data["Type"], "BUY", qty, hedge_fill["Price"] or t_data["Hedge"]["LTP"], str(resp_hedge['nOrdNo']))
             
             if not isinstance(resp_main, dict) or 'nOrdNo' not in resp_main:
                 bot.send_message(cid, f"⚠️ Hedge placed, but Main SELL failed: {resp_main}")
@@ -595,6 +2153,15 @@ def on_callback(call):
                 bot.send_message(cid, f"✅ Trade Executed!\nID: {resp_main['nOrdNo']}\n\n**Set Stop Loss?**", reply_markup=mk)
         except Exception as e: bot.send_message(cid, f"❌ Execution Err: {e}")
 
+    elif call.data == "PNL_LIVE":
+        try:
+            if not start_live_pnl(cid): bot.answer_callback_query(call.id, "No Open Trades!")
+        except Exception as e: bot.send_message(cid, f"P&L Error: {e}")
+
+    elif call.data == "PNL_STOP":
+        view = LIVE_PNL.get(cid)
+        stop_live_pnl(cid, (view["Text"] + "\n\n⏹️ Live P&L stopped.") if view else None)
+
     elif call.data == "CANCEL_TRADE":
         bot.edit_message_text("🚫 Cancelled.", cid, call.message.message_id)
 
@@ -604,7 +2171,7 @@ def on_callback(call):
     # --- STOP LOSS CALLBACKS ---
     elif call.data == "SL_LIST_POSITIONS":
         try:
-            open_sells = list(trades_col.find({"ChatID": str(cid), "Status": "OPEN", "Side": "SELL"}))
+            open_sells = find_open_trades(cid, "SELL")
             if not open_sells:
                 bot.answer_callback_query(call.id, "No Open SELL Positions!")
                 return
@@ -630,7 +2197,7 @@ def on_callback(call):
         parts = call.data.split("_")
         oid, pct = parts[1], float(parts[2])
         try:
-            row = trades_col.find_one({"OrderID": str(oid)})
+            row = find_trade(oid)
             if not row: return
             
             sl_id = str(row.get('SLOrderID', ""))
@@ -646,7 +2213,7 @@ def on_callback(call):
             resp = client.place_order(exchange_segment=conf["Exchange"], product="NRML", price=str(sl_limit), order_type="SL", quantity=str(int(row['Qty'])), validity="DAY", trading_symbol=row['TradeSymbol'], transaction_type="B", trigger_price=str(sl_trigger), amo="NO")
             
             if isinstance(resp, dict) and 'nOrdNo' in resp:
-                trades_col.update_one({"_id": row["_id"]}, {"$set": {"SLOrderID": str(resp['nOrdNo']), "SLPrice": sl_trigger}})
+                update_trade(row["_id"], {"SLOrderID": str(resp['nOrdNo']), "SLPrice": sl_trigger})
                 bot.edit_message_text(f"✅ SL Set at {sl_trigger}\nOrder ID: {resp['nOrdNo']}", cid, call.message.message_id)
             else: bot.send_message(cid, f"❌ SL Failed: {resp}")
         except Exception as e: bot.send_message(cid, f"❌ SL Set Error: {e}")
@@ -654,26 +2221,21 @@ def on_callback(call):
     elif call.data.startswith("SLCANCEL_"):
         oid = call.data.split("_")[1]
         try:
-            row = trades_col.find_one({"OrderID": str(oid)})
+            row = find_trade(oid)
             if not row: return
             sl_id = str(row.get('SLOrderID', ""))
             if sl_id != "" and sl_id != "nan":
                 try: USER_SESSIONS[cid].cancel_order(order_id=sl_id)
                 except: pass
-                trades_col.update_one({"_id": row["_id"]}, {"$set": {"SLOrderID": "", "SLPrice": 0}})
+                update_trade(row["_id"], {"SLOrderID": "", "SLPrice": 0})
                 bot.edit_message_text("🗑️ SL Cancelled.", cid, call.message.message_id)
         except Exception as e: bot.send_message(cid, f"❌ SL Cancel Error: {e}")
 
     elif call.data == "SL_CANCEL_ALL":
         try:
-            open_sl = list(trades_col.find({"ChatID": str(cid), "Status": "OPEN"}))
-            client = USER_SESSIONS[cid]
-            for row in open_sl:
-                sl_id = str(row.get('SLOrderID', ""))
-                if sl_id != "" and sl_id != "nan":
-                    try: client.cancel_order(order_id=sl_id)
-                    except: pass
-                    trades_col.update_one({"_id": row["_id"]}, {"$set": {"SLOrderID": "", "SLPrice": 0}})
+            open_sl = find_open_trades(cid, with_sl=True)
+            cancel_orders(USER_SESSIONS[cid], [str(r['SLOrderID']) for r in open_sl])
+            bulk_update_trades([(r["_id"], {"SLOrderID": "", "SLPrice": 0}) for r in open_sl])
             bot.edit_message_text("🗑️ All active SL orders have been cancelled.", cid, call.message.message_id)
         except Exception as e: bot.send_message(cid, f"❌ Cancel All Err: {e}")
 
@@ -681,48 +2243,22 @@ def on_callback(call):
     elif call.data == "EXIT_ALL_CONFIRM":
         bot.edit_message_text("🚨 **INITIATING SAFE EXIT SEQUENCE...**", cid, call.message.message_id)
         try:
-            open_rows = list(trades_col.find({"ChatID": str(cid), "Status": "OPEN"}))
+            open_rows = find_open_trades(cid)
             if not open_rows:
                 bot.send_message(cid, "✅ No Open Positions.")
                 return
             client = USER_SESSIONS[cid]
             
             # 1. Cancel SL Orders
-            for row in open_rows:
-                sl_id = str(row.get('SLOrderID', ""))
-                if sl_id != "" and sl_id != "nan":
-                    try: client.cancel_order(order_id=sl_id)
-                    except: pass
-            
-            # 2. EXIT ALL SELLS
-            sells = [r for r in open_rows if r['Side'] == 'SELL']
-            for row in sells:
-                conf = INDICES_CONFIG[row['Index']]
-                ex_ltp = 0
-                try:
-                    q = client.quotes(instrument_tokens=[{"instrument_token": str(row['Token']), "exchange_segment": conf["Exchange"]}], quote_type="all")
-                    item = q[0] if isinstance(q, list) else q.get('data', [{}])[0]
-                    ex_ltp = float(item.get('ltp', item.get('lastPrice', 0)))
-                except: pass
-                client.place_order(exchange_segment=conf["Exchange"], product="NRML", price="0", order_type="MKT", quantity=str(int(row['Qty'])), validity="DAY", trading_symbol=row['TradeSymbol'], transaction_type="B", amo="NO")
-                trades_col.update_one({"_id": row["_id"]}, {"$set": {"Status": "CLOSED", "ExitPrice": ex_ltp}})
+            cancel_orders(client, [str(r.get('SLOrderID', "")) for r in open_rows])
             
-            time.sleep(0.5)
+            # 2. EXIT ALL SELLS, fills confirm, phir 3. EXIT ALL BUYS
+            closed, pending, failed = execute_exit(client, open_rows)
             
-            # 3. EXIT ALL BUYS
-            buys = [r for r in open_rows if r['Side'] == 'BUY']
-            for row in buys:
-                conf = INDICES_CONFIG[row['Index']]
-                ex_ltp = 0
-                try:
-                    q = client.quotes(instrument_tokens=[{"instrument_token": str(row['Token']), "exchange_segment": conf["Exchange"]}], quote_type="all")
-                    item = q[0] if isinstance(q, list) else q.get('data', [{}])[0]
-                    ex_ltp = float(item.get('ltp', item.get('lastPrice', 0)))
-                except: pass
-                client.place_order(exchange_segment=conf["Exchange"], product="NRML", price="0", order_type="MKT", quantity=str(int(row['Qty'])), validity="DAY", trading_symbol=row['TradeSymbol'], transaction_type="S", amo="NO")
-                trades_col.update_one({"_id": row["_id"]}, {"$set": {"Status": "CLOSED", "ExitPrice": ex_ltp}})
-                
-            bot.send_message(cid, "🏁 **SAFE EXIT COMPLETE.**\nAll Sells closed before Buys.")
+            msg = f"🏁 **SAFE EXIT COMPLETE.**\nAll Sells closed before Buys. ({closed} closed)"
+            if pending: msg += f"\n⏳ Fill not confirmed yet: {', '.join(r['TradeSymbol'] for r in pending)}"
+            if failed: msg += "\n❌ Not exited:\n" + "\n".join(f"{r['TradeSymbol']}: {err}" for r, err in failed)
+            bot.send_message(cid, msg)
         except Exception as e: bot.send_message(cid, f"❌ Exit All Error: {e}")
 
 # =========================================
@@ -732,13 +2268,50 @@ import os
 from http.server import BaseHTTPRequestHandler, HTTPServer
 import threading
 
+def metric_gauges():
+    with POSITIONS_LOCK: positions = sum(len(rows) for rows in POSITIONS.values())
+    return {"opbot_dispatch_queue_depth": DISPATCHER.depth(), "opbot_trade_writes_pending": TRADE_WRITES.qsize() + len(TRADE_BACKLOG),
+            "opbot_sl_events_pending": SL_EVENTS.qsize(), "opbot_pending_exits": sum(len(v) for v in list(PENDING_EXITS.values())),
+            "opbot_sessions_active": len(USER_SESSIONS), "opbot_sessions_saved": len(SAVED_SESSIONS),
+            "opbot_users": len(USER_DETAILS), "opbot_open_positions": positions, "opbot_chains_active": sum(1 for c in ACTIVE_TOKENS.values() if c),
+            "opbot_live_pnl_views": len(LIVE_PNL), "opbot_feed_open": int(bool(FEED["Open"])),
+            "opbot_feed_subscribed_tokens": len(FEED["Subscribed"]),
+            "opbot_refresh_keys": len(REFRESH_DUE), "opbot_broker_budget": round(BROKER_BUDGET.available(), 1), "opbot_feed_last_tick_age_seconds": round(time.time() - FEED["LastTick"], 1) if FEED["LastTick"] else -1}
+
+def render_metrics():
+    def fmt(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        return "{" + ",".join(f'{k}="{str(v)}"' for k, v in pairs) + "}" if pairs else ""
+    with METRICS_LOCK: items = sorted((k, (dict(v, Buckets=list(v["Buckets"])) if isinstance(v, dict) else v)) for k, v in METRICS.items())
+    lines, typed = [], set()
+    for (name, labels), v in items:
+        if name not in typed:
+            lines.append(f"# TYPE {name} {'histogram' if isinstance(v, dict) else 'counter'}")
+            typed.add(name)
+        if not isinstance(v, dict):
+            lines.append(f"{name}{fmt(labels)} {v}")
+            continue
+        acc = 0
+        for le, n in zip(list(METRIC_BUCKETS) + ["+Inf"], v["Buckets"]):
+            acc += n
+            lines.append(f"{name}_bucket{fmt(labels, [('le', le)])} {acc}")
+        lines.append(f"{name}_sum{fmt(labels)} {round(v['Sum'], 6)}")
+        lines.append(f"{name}_count{fmt(labels)} {v['Count']}")
+    for name, val in metric_gauges().items(): lines += [f"# TYPE {name} gauge", f"{name} {val}"]
+    return "\n".join(lines) + "\n"
+
+def health_response(path):
+    if path.split("?")[0] == "/metrics": return 200, "text/plain; version=0.0.4", render_metrics().encode()
+    return 200, "text/plain", b"Bot is active and polling!"
+
 # Dummy server class to keep Render Web Service happy
 class DummyHandler(BaseHTTPRequestHandler):
     def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
+        status, ctype, body = health_response(self.path)
+        self.send_response(status)
+        self.send_header('Content-type', ctype)
         self.end_headers()
-        self.wfile.write(b"Bot is active and polling!")
+        self.wfile.write(body)
 
 def keep_alive():
     # Render assigns a PORT environment variable dynamically
@@ -751,9 +2324,108 @@ def start_bot():
     print("🤖 Bot is polling...")
     bot.infinity_polling()
 
-if __name__ == "__main__":
+# =========================================
+# --- 9. ASYNC MODE (BOT_MODE=async) ---
+# =========================================
+async def health_server():
+    async def serve(reader, writer):
+        try:
+            line = await reader.readline()
+            parts = line.decode(errors="ignore").split()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""): pass
+            status, ctype, body = health_response(parts[1] if len(parts) > 1 else "/")
+            writer.write(f"HTTP/1.1 {status} OK\r\nContent-Type: {ctype}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except Exception as e: print(f"Health Server Error: {e}")
+        finally: writer.close()
+    port = int(os.environ.get("PORT", 8080))
+    server = await asyncio.start_server(serve, '0.0.0.0', port)
+    print(f"🌐 Async web server running on port {port}")
+    async with server: await server.serve_forever()
+
+async def trade_writer_task():
+    while True:
+        try: await asyncio.to_thread(trade_writer_step)
+        except Exception as e:
+            metric_inc("opbot_errors_total", where="trade_writer")
+            print(f"Trade Writer Error: {e}")
+            await asyncio.sleep(WORKER_WAIT)
+
+async def pnl_refresher_task():
+    # Sleep event loop pe, executor thread sirf step ke liye
+    while True:
+        await asyncio.sleep(PNL_EDIT_INTERVAL)
+        await asyncio.to_thread(pnl_refresher_step)
+
+async def session_keeper_task():
+    while True:
+        await asyncio.to_thread(session_keeper_step)
+        await asyncio.sleep(SESSION_CHECK_INTERVAL)
+
+async def master_ingester_task():
+    while True:
+        await asyncio.to_thread(master_ingest_step)
+        await asyncio.sleep(SESSION_CHECK_INTERVAL)
+
+async def sl_monitor_task():
+    while True: await asyncio.to_thread(sl_monitor_step)
+
+async def refresh_scheduler_task():
+    while True:
+        try: wait = await asyncio.to_thread(refresh_scheduler_step)
+        except Exception as e:
+            print(f"Scheduler Error: {e}")
+            wait = REFRESH_FAST
+        await asyncio.sleep(wait)
+
+async def run_async():
+    # aiohttp sirf async mode mein chahiye
+    from telebot.async_telebot import AsyncTeleBot
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=CHAT_WORKERS, thread_name_prefix="async"))
+    chat_locks, running = {}, set()
+
+    async def handle(update):
+        msg = update.message or (update.callback_query.message if update.callback_query else None)
+        key = msg.chat.id if msg else None
+        async with chat_locks.setdefault(key, asyncio.Lock()):
+            # Handler + broker SDK calls blocking hain: executor thread mein
+            try: await asyncio.to_thread(bot.process_new_updates, [update])
+            except Exception as e:
+                metric_inc("opbot_errors_total", where="handler")
+                print(f"Handler Error ({key}): {e}")
+
+    class AsyncRouter(AsyncTeleBot):
+        async def process_new_updates(self, updates):
+            for update in updates:
+                task = asyncio.create_task(handle(update))
+                running.add(task)
+                task.add_done_callback(running.discard)
+
+    abot = AsyncRouter(BOT_TOKEN)
+    tasks = [asyncio.create_task(t()) for t in (health_server, trade_writer_task, sl_monitor_task, refresh_scheduler_task, pnl_refresher_task, session_keeper_task, master_ingester_task)]
+    print("🤖 Async bot is polling...")
+    try: await abot.infinity_polling()
+    finally:
+        for t in tasks: t.cancel()
+
+def main_async():
+    while True:
+        try:
+            asyncio.run(run_async())
+        except Exception as e:
+            print(f"Async bot crashed: {e}")
+            time.sleep(10)
+
+if __name__ == "__main__": load_state()
+
+if __name__ == "__main__" and BOT_MODE == "async":
+    main_async()
+
+elif __name__ == "__main__":
     # Start the dummy server in a background thread
     threading.Thread(target=keep_alive, daemon=True).start()
+    start_workers()
     
     # Start the Telegram bot in the main thread
     while True: